@@ -0,0 +1,332 @@
+"""Synthetic load benchmark of the parse, ingest, query and render stages and of the Flask routes.
+
+Generates DMARC aggregate reports from a seed, imports them into a store in
+a scratch directory, with owners resolved by a local stub RDAP server, and
+times every stage. The results are printed and written as JSON, pass an
+earlier result file with --compare to see what changed.
+
+    python benchmark.py --domains 5 --reports 200 --records 50 --output before.json
+    python benchmark.py --domains 5 --reports 200 --records 50 --compare before.json
+"""
+import os, io, sys, json, gzip, math, time, random, shutil, zipfile, argparse, platform, tempfile, threading, subprocess
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ORGS = ['google.com', 'Yahoo', 'Microsoft Corporation', 'Mail.Ru', 'comcast.net', 'Enterprise Outlook']
+DISPOSITIONS = ['none', 'none', 'none', 'quarantine', 'reject']
+SPF_FAILURES = ['fail', 'softfail', 'neutral', 'none', 'temperror', 'permerror']
+DKIM_FAILURES = ['fail', 'fail', 'none', 'temperror', 'permerror']
+
+
+class RDAPHandler(BaseHTTPRequestHandler):
+    # Every /24 is its own network, owned by one of a few hundred organisations
+    latency = 0.0
+
+    def do_GET(self):
+        ip = self.path.rstrip('/').rpartition('/')[2]
+        octets = ip.split('.')
+        if len(octets) != 4:
+            self.send_response(404)
+            self.end_headers()
+            return
+        network = '.'.join(octets[:3])
+        body = json.dumps({
+            'name': f'NET-{octets[0]}-{int(octets[1]) % 300}',
+            'startAddress': f'{network}.0',
+            'endAddress': f'{network}.255',
+            'cidr0_cidrs': [{'v4prefix': f'{network}.0', 'length': 24}]
+        }).encode()
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rdap+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_rdap_stub(latency=0.0):
+    RDAPHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RDAPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def senders(rng, count):
+    # Addresses spread over a few /24 networks, like the outbound servers of a mail provider
+    networks = [f'{rng.randint(11, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}' for _ in range(max(1, count // 8))]
+    return [f'{rng.choice(networks)}.{rng.randint(1, 254)}' for _ in range(count)]
+
+
+def generate_report(rng, domain, org, report_id, begin, records, fail_rate, legitimate, spoofers):
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8" ?>',
+        '<feedback>',
+        '  <version>1.0</version>',
+        f'  <report_metadata><org_name>{org}</org_name><email>noreply-dmarc@{org.split()[0].lower()}</email>'
+        f'<report_id>{report_id}</report_id><date_range><begin>{begin}</begin><end>{begin + 86399}</end></date_range></report_metadata>',
+        f'  <policy_published><domain>{domain}</domain><adkim>r</adkim><aspf>r</aspf><p>quarantine</p><sp>none</sp><pct>100</pct><fo>1</fo></policy_published>'
+    ]
+    for _ in range(records):
+        failing = rng.random() < fail_rate
+        source_ip = rng.choice(spoofers if failing else legitimate)
+        count = min(int(rng.paretovariate(1.2)), 5000)
+        if failing:
+            dkim = rng.choice(DKIM_FAILURES)
+            spf = rng.choice(SPF_FAILURES)
+            envelope_from = rng.choice([domain, f'bounce.{domain}', f'mail{rng.randint(1, 99)}.example.net'])
+        else:
+            dkim = 'pass'
+            spf = rng.choice(['pass', 'pass', 'pass', 'softfail'])
+            envelope_from = domain
+        policy_dkim = 'pass' if dkim == 'pass' else 'fail'
+        policy_spf = 'pass' if spf == 'pass' else 'fail'
+        disposition = 'none' if 'pass' in (policy_dkim, policy_spf) else rng.choice(DISPOSITIONS)
+        lines.append(
+            f'  <record><row><source_ip>{source_ip}</source_ip><count>{count}</count><policy_evaluated>'
+            f'<disposition>{disposition}</disposition><dkim>{policy_dkim}</dkim><spf>{policy_spf}</spf></policy_evaluated></row>'
+            f'<identifiers><envelope_to>{domain}</envelope_to><envelope_from>{envelope_from}</envelope_from><header_from>{domain}</header_from></identifiers>'
+            f'<auth_results><dkim><domain>{domain}</domain><result>{dkim}</result><selector>s{rng.randint(1, 3)}</selector></dkim>'
+            f'<spf><domain>{envelope_from}</domain><result>{spf}</result></spf></auth_results></record>'
+        )
+    lines.append('</feedback>\n')
+    return '\n'.join(lines).encode()
+
+
+def wrap(rng, name, xml):
+    # Mail providers send either a zip archive or a gzip file
+    if rng.random() < 0.5:
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w') as archive:
+            # A fixed timestamp, so the same seed gives the same bytes
+            archive.writestr(zipfile.ZipInfo(f'{name}.xml', date_time=(2000, 1, 1, 0, 0, 0)), xml, compress_type=zipfile.ZIP_DEFLATED)
+        return f'{name}.zip', data.getvalue()
+    return f'{name}.xml.gz', gzip.compress(xml, mtime=0)
+
+
+def generate_attachments(seed, domains, reports, records, fail_rate, end_date):
+    """(name, content, XML, records) of `reports` attachments per domain, the same for the same arguments."""
+    rng = random.Random(seed)
+    end = int(datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+    attachments = []
+    for number in range(domains):
+        domain = f'domain{number}.example'
+        legitimate = senders(rng, 40)
+        spoofers = senders(rng, 200)
+        for index in range(reports):
+            org = ORGS[index % len(ORGS)]
+            # Spread over the 30 days before the end date, a few reports per provider and day
+            begin = end - 86400 * (1 + rng.randrange(30))
+            size = max(1, int(rng.gauss(records, records / 3)))
+            xml = generate_report(rng, domain, org, f'{seed}-{number}-{index}', begin, size, fail_rate, legitimate, spoofers)
+            name, content = wrap(rng, f'{org.split()[0].lower()}!{domain}!{begin}!{begin + 86399}', xml)
+            attachments.append((name, content, xml, size))
+    return attachments
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(samples, items, unit):
+    total = sum(samples)
+    return {
+        'calls': len(samples),
+        'items': items,
+        'unit': unit,
+        'total': round(total, 6),
+        'p50': round(percentile(samples, 0.5), 6),
+        'p95': round(percentile(samples, 0.95), 6),
+        'max': round(max(samples), 6),
+        'throughput': round(items / total, 2) if total else None
+    }
+
+
+class Timer:
+    """Latency samples per stage, the time of every call and the items it handled."""
+
+    def __init__(self):
+        self.samples = {}
+        self.items = {}
+        self.units = {}
+
+    def measure(self, stage, function, *args, items=1, unit='calls', **kwargs):
+        started = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        self.samples.setdefault(stage, []).append(elapsed)
+        self.items[stage] = self.items.get(stage, 0) + items
+        self.units[stage] = unit
+        return result
+
+    def results(self):
+        return {stage: summarize(samples, self.items[stage], self.units[stage]) for stage, samples in self.samples.items()}
+
+
+def read_response(client, url):
+    response = client.get(url)
+    # Streamed pages are only rendered while the body is read
+    body = response.get_data()
+    if response.status_code != 200:
+        raise RuntimeError(f'{url} returned {response.status_code}')
+    return body
+
+
+def run(args):
+    rdap = start_rdap_stub(args.rdap_latency / 1000)
+    # Read by the modules at import time, the scratch directory holds every file they write
+    os.environ['RDAP_URL'] = f'http://127.0.0.1:{rdap.server_port}/ip/'
+    os.environ['RDAP_RATE_LIMIT'] = '0'
+    os.environ['REPORT_BACKEND'] = args.backend
+    os.environ['CHART_MODE'] = args.chart_mode
+    # Only problems are logged unless asked for, as a production setup would
+    os.environ['LOG_LEVEL'] = 'DEBUG' if args.verbose else 'WARNING'
+    os.chdir(args.workdir)
+
+    from dmarc_parser import parse_dmarc_report, LXML
+    from decompression import read_members
+    from ingest import import_attachments
+    from report_store import store, open_store, RESULT_COLUMNS
+    from report_tables import failure_tables
+    from charts import chart_data, chart_urls
+    from dmarc_analyzer import app
+
+    timer = Timer()
+    started = time.perf_counter()
+    attachments = generate_attachments(args.seed, args.domains, args.reports, args.records, args.fail_rate, args.end_date)
+    records = sum(size for _, _, _, size in attachments)
+    print(f'Generated {len(attachments)} attachments with {records} records in {time.perf_counter() - started:.1f}s')
+
+    for name, content, _, size in attachments:
+        timer.measure('decompress', read_members, name, content, items=size, unit='records')
+    for _, _, xml, size in attachments:
+        timer.measure('parse', parse_dmarc_report, io.BytesIO(xml), items=size, unit='records')
+
+    store.load()
+    for start in range(0, len(attachments), args.batch_size):
+        batch = attachments[start:start + args.batch_size]
+        timer.measure('ingest', import_attachments, [(name, content) for name, content, _, _ in batch], args.workers,
+                      items=sum(size for _, _, _, size in batch), unit='records')
+    # Imported again, every attachment is known and skipped
+    for start in range(0, len(attachments), args.batch_size):
+        batch = attachments[start:start + args.batch_size]
+        timer.measure('ingest.duplicates', import_attachments, [(name, content) for name, content, _, _ in batch], args.workers,
+                      items=len(batch), unit='attachments')
+    for _ in range(args.repeat):
+        timer.measure('load', lambda: open_store(args.backend).load(), items=records, unit='records')
+
+    domains = [f'domain{number}.example' for number in range(args.domains)]
+    end = args.end_date
+    start = (datetime.strptime(end, '%Y-%m-%d') - timedelta(days=7)).strftime('%Y-%m-%d')
+    filters = [(domain, None, None) for domain in domains] + [(domain, start, end) for domain in domains]
+    for _ in range(args.repeat):
+        for domain, start_date, end_date in filters:
+            timer.measure('query.count_reports', store.count_reports, domain, start_date, end_date)
+            counts = timer.measure('query.result_counts', store.result_counts, RESULT_COLUMNS, domain, start_date, end_date, weighted=True)
+            summary = timer.measure('query.failure_summary', store.failure_summary, RESULT_COLUMNS, domain, start_date, end_date)
+            for column in RESULT_COLUMNS:
+                timer.measure('query.failed_groups', store.failed_groups, column, domain, start_date, end_date, limit=100)
+                timer.measure('query.failed_page', store.failed_page, column, domain, start_date, end_date, limit=100)
+            timer.measure('render.chart_data', chart_data, counts)
+            with app.test_request_context(f'/reports?domain={domain}'):
+                timer.measure('render.failure_tables', lambda: list(failure_tables(store, summary, domain, start_date, end_date)))
+    if args.chart_mode == 'server':
+        # Without a cache key every call draws the PNGs
+        for domain, start_date, end_date in filters[:args.repeat]:
+            counts = store.result_counts(RESULT_COLUMNS, domain, start_date, end_date, weighted=True)
+            timer.measure('render.chart_urls', chart_urls, counts)
+
+    client = app.test_client()
+    routes = ['/', '/api/rollups', '/api/rollups?days=30', '/metrics']
+    for domain in domains:
+        routes += [f'/reports?domain={domain}', f'/reports?domain={domain}&view=records',
+                   f'/reports?domain={domain}&start_date={start}&end_date={end}&sort=count&order=desc',
+                   f'/api/reports/aggregates?domain={domain}']
+    for _ in range(args.repeat):
+        for url in routes:
+            route = 'GET ' + url.split('?')[0] + ('?view=records' if 'view=records' in url else '')
+            timer.measure(route, read_response, client, url)
+
+    rdap.shutdown()
+    return {
+        'version': git_version(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'lxml': LXML,
+        'parameters': {name: value for name, value in vars(args).items() if name not in ('workdir', 'output', 'compare', 'keep', 'verbose')},
+        'attachments': len(attachments),
+        'records': records,
+        'stages': timer.results()
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    stages = baseline['stages'] if baseline else {}
+    print(f"{'stage':<40}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'throughput':>14}  unit" + ('   p50 change  p95 change' if baseline else ''))
+    for stage, result in results['stages'].items():
+        line = (f"{stage:<40}{result['calls']:>7}{result['p50'] * 1000:>10.2f}{result['p95'] * 1000:>10.2f}"
+                f"{result['throughput'] or 0:>14.1f}  {result['unit']}/s")
+        previous = stages.get(stage)
+        if previous and previous['p50'] and previous['p95']:
+            line += f"{result['p50'] / previous['p50'] - 1:>+12.0%}{result['p95'] / previous['p95'] - 1:>+12.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DMARC analyzer on generated reports')
+    parser.add_argument('--domains', type=int, default=3, help='domains the reports are about (default: 3)')
+    parser.add_argument('--reports', type=int, default=100, help='reports per domain (default: 100)')
+    parser.add_argument('--records', type=int, default=50, help='average records per report (default: 50)')
+    parser.add_argument('--fail-rate', type=float, default=0.2, help='share of records from failing senders (default: 0.2)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generator (default: 1)')
+    parser.add_argument('--end-date', default=datetime.now().strftime('%Y-%m-%d'), help='day after the last report (default: today)')
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json', help='report store (default: json)')
+    parser.add_argument('--chart-mode', choices=['client', 'server'], default='client', help='how the report page draws its charts (default: client)')
+    parser.add_argument('--workers', type=int, default=None, help='parser processes of the import (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=200, help='attachments per import (default: 200)')
+    parser.add_argument('--repeat', type=int, default=3, help='rounds of the query, render and route stages (default: 3)')
+    parser.add_argument('--rdap-latency', type=float, default=0, help='milliseconds the stub RDAP server takes per lookup (default: 0)')
+    parser.add_argument('--workdir', help='directory for the store and caches (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--output', default='benchmark_results.json', help='file the results are written to (default: benchmark_results.json)')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    parser.add_argument('--verbose', action='store_true', help='log at debug level')
+    args = parser.parse_args()
+
+    # Paths given on the command line are relative to where the benchmark was started
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    temporary = args.workdir is None
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='dmarc-benchmark-'))
+    os.makedirs(args.workdir, exist_ok=True)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        results = run(args)
+    finally:
+        os.chdir(os.path.dirname(output))
+        if temporary and not args.keep:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+    print_results(results, baseline)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
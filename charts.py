@@ -0,0 +1,158 @@
+import os, hashlib, json, threading
+from collections import OrderedDict
+from metrics import timed_stage
+
+# 'client' draws the charts in the browser, 'server' renders them as PNG files with matplotlib
+CHART_MODE = os.getenv('CHART_MODE', 'client')
+CHART_FOLDER = os.path.join('static', 'charts')
+CHART_CACHE_MAX_FILES = int(os.getenv('CHART_CACHE_MAX_FILES', 400))
+CHART_CACHE_MAX_BYTES = int(os.getenv('CHART_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+
+
+# Pie charts of the report page: result column, counted values with their labels and colours,
+# the exploded slice and the title. The same definitions drive the PNGs and the client-side charts.
+CHARTS = [
+    {
+        'name': 'dkim_results',
+        'column': 'auth_results_dkim_result',
+        'title': 'DMARC Report: DKIM Results',
+        'results': ['pass', 'fail'],
+        'labels': ['Pass', 'Fail'],
+        'colors': ['green', 'red'],
+        'explode': [0.1, 0]
+    },
+    {
+        'name': 'spf_results',
+        'column': 'auth_results_spf_result',
+        'title': 'DMARC Report: SPF Results',
+        'results': ['pass', 'fail', 'none', 'neutral', 'softfail', 'temperror', 'permerror'],
+        'labels': ['Pass', 'Fail', 'None', 'Neutral', 'Softfail', 'Temperror', 'Permerror'],
+        'colors': ['green', 'red', 'grey', 'blue', 'yellow', 'orange', 'purple'],
+        'explode': [0, 0.1, 0, 0, 0, 0, 0]
+    },
+    {
+        'name': 'dkim_policy_results',
+        'column': 'policy_evaluated_dkim',
+        'title': 'DMARC Report: DKIM Policy Results',
+        'results': ['pass', 'fail'],
+        'labels': ['Pass', 'Fail'],
+        'colors': ['green', 'red'],
+        'explode': [0.1, 0]
+    },
+    {
+        'name': 'spf_policy_results',
+        'column': 'policy_evaluated_spf',
+        'title': 'DMARC Report: SPF Policy Results',
+        'results': ['pass', 'fail'],
+        'labels': ['Pass', 'Fail'],
+        'colors': ['green', 'red'],
+        'explode': [0, 0.1]
+    }
+]
+
+plt = None
+
+
+def pyplot():
+    # matplotlib takes a while to import, so it is only loaded once a PNG is actually rendered
+    global plt
+    if plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot
+        plt = pyplot
+    return plt
+
+
+def chart_sizes(chart, results):
+    # Values a chart has no slice for are left out, like before
+    return [results.get(result, 0) for result in chart['results']]
+
+
+def chart_data(counts):
+    # What a client needs to draw the charts itself
+    return [dict(chart, sizes=chart_sizes(chart, counts[chart['column']])) for chart in CHARTS]
+
+
+@timed_stage('chart')
+def create_pie_chart(chart, results, path):
+    plt = pyplot()
+    plt.figure(figsize=(6, 6))
+    plt.pie(chart_sizes(chart, results), explode=chart['explode'], labels=chart['labels'], colors=chart['colors'], autopct='%1.1f%%',
+            shadow=True, startangle=140)
+    plt.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
+    plt.title(chart['title'])
+    plt.savefig(path, format='png')
+    plt.close()
+
+
+# pyplot keeps global state and must not draw two figures at once
+render_lock = threading.Lock()
+cache_lock = threading.Lock()
+# (domain, start_date, end_date, data version) -> chart URLs, so unchanged data skips counting as well
+chart_urls_cache = OrderedDict()
+
+
+def chart_file(chart, results):
+    # The file name is derived from the drawn sizes, identical data always maps to the same image
+    digest = hashlib.sha256(json.dumps([chart['name'], chart_sizes(chart, results)]).encode('utf-8')).hexdigest()[:32]
+    return f"{chart['name']}_{digest}.png"
+
+
+def render_chart(chart, results):
+    file_name = chart_file(chart, results)
+    path = os.path.join(CHART_FOLDER, file_name)
+    if os.path.exists(path):
+        # Mark as recently used for eviction
+        os.utime(path)
+        return file_name
+    os.makedirs(CHART_FOLDER, exist_ok=True)
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with render_lock:
+        create_pie_chart(chart, results, tmp_path)
+    os.replace(tmp_path, path)
+    evict_charts()
+    return file_name
+
+
+def evict_charts():
+    with cache_lock:
+        entries = []
+        for file_name in os.listdir(CHART_FOLDER):
+            if file_name.endswith('.png'):
+                stat = os.stat(os.path.join(CHART_FOLDER, file_name))
+                entries.append((stat.st_mtime, stat.st_size, file_name))
+        entries.sort(reverse=True)
+        total = 0
+        for position, (_, size, file_name) in enumerate(entries):
+            total += size
+            if position >= CHART_CACHE_MAX_FILES or total > CHART_CACHE_MAX_BYTES:
+                try:
+                    os.remove(os.path.join(CHART_FOLDER, file_name))
+                except FileNotFoundError:
+                    pass
+
+
+def chart_urls(counts, key=None):
+    """Return the URLs of the four pie charts, rendering only the ones not cached yet.
+
+    `counts` maps each result column to its value counts, or is a callable
+    returning that mapping so it is only evaluated when `key` (domain, date
+    range and data version) has not been seen before.
+    """
+    if key is not None:
+        with cache_lock:
+            urls = chart_urls_cache.get(key)
+            if urls is not None:
+                chart_urls_cache.move_to_end(key)
+        if urls is not None and all(os.path.exists(url) for url in urls):
+            return urls
+    if callable(counts):
+        counts = counts()
+    urls = [f"{CHART_FOLDER}/{render_chart(chart, counts[chart['column']])}".replace(os.sep, '/') for chart in CHARTS]
+    if key is not None:
+        with cache_lock:
+            chart_urls_cache[key] = urls
+            while len(chart_urls_cache) > CHART_CACHE_MAX_FILES:
+                chart_urls_cache.popitem(last=False)
+    return urls
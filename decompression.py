@@ -0,0 +1,159 @@
+import os, io, gzip, time, uuid, zlib, shutil, logging, zipfile
+from metrics import stage_seconds, decompressed_bytes_total, rejections_total
+
+# Limits per attachment, an attachment over any of them is rejected as a whole
+MAX_REPORT_SIZE = int(os.getenv('MAX_REPORT_SIZE', 100 * 1024 * 1024))
+MAX_COMPRESSION_RATIO = int(os.getenv('MAX_COMPRESSION_RATIO', 200))
+MAX_ZIP_MEMBERS = int(os.getenv('MAX_ZIP_MEMBERS', 20))
+# The ratio is only checked past this size, small reports can compress unusually well
+RATIO_MIN_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+QUARANTINE_FOLDER = os.getenv('QUARANTINE_FOLDER', './quarantine')
+
+# 'invalid' are extracted reports that failed to parse
+REASONS = ['size', 'ratio', 'members', 'corrupt', 'invalid']
+
+logger = logging.getLogger(__name__)
+
+# Truncated or damaged archives, and zip members that are encrypted or use an unsupported method
+CORRUPT_ERRORS = (zipfile.BadZipFile, gzip.BadGzipFile, EOFError, zlib.error, NotImplementedError, RuntimeError)
+
+
+class RejectedAttachment(Exception):
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def check_size(size, compressed_size):
+    if size > MAX_REPORT_SIZE:
+        raise RejectedAttachment('size', f'more than {MAX_REPORT_SIZE} bytes decompressed')
+    if size > RATIO_MIN_SIZE and size > compressed_size * MAX_COMPRESSION_RATIO:
+        raise RejectedAttachment('ratio', f'compression ratio above {MAX_COMPRESSION_RATIO}')
+
+
+class Budget:
+    """Bytes decompressed so far from one attachment."""
+
+    def __init__(self, compressed_size):
+        self.compressed_size = compressed_size
+        self.size = 0
+
+    def take(self, size):
+        self.size += size
+        check_size(self.size, self.compressed_size)
+
+
+def copy_limited(source, target, budget):
+    # Never holds more than one chunk, stops as soon as the attachment is over its limits
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        budget.take(len(chunk))
+        target.write(chunk)
+
+
+def is_compressed(magic):
+    return magic[:4] == b'PK\x03\x04' or magic[:2] == b'\x1f\x8b'
+
+
+def open_members(file, compressed_size):
+    """(zip member name, binary file) of every XML report in an attachment, decompressed as it is read.
+
+    Recognised by content, attachment names are not reliable. The member
+    name is None outside of zip archives. Zip archives are rejected by their
+    member count and declared sizes before anything is decompressed.
+    """
+    magic = file.read(4)
+    file.seek(0)
+    if magic == b'PK\x03\x04':
+        archive = zipfile.ZipFile(file)
+        members = archive.infolist()
+        if len(members) > MAX_ZIP_MEMBERS:
+            raise RejectedAttachment('members', f'{len(members)} zip members, at most {MAX_ZIP_MEMBERS} allowed')
+        check_size(sum(member.file_size for member in members), compressed_size)
+        return [(member.filename, archive.open(member)) for member in members
+                if member.filename.endswith('.xml') and not member.is_dir()]
+    if magic[:2] == b'\x1f\x8b':
+        return [(None, gzip.GzipFile(fileobj=file))]
+    return [(None, file)]
+
+
+def read_members(name, content):
+    """(name, XML) of every report in an attachment held in memory, within the limits."""
+    budget = Budget(len(content))
+    if not is_compressed(content[:4]):
+        budget.take(len(content))
+        return [(name, content)]
+    try:
+        with stage_seconds.timer(stage='decompress'):
+            reports = []
+            for member_name, source in open_members(io.BytesIO(content), len(content)):
+                xml = io.BytesIO()
+                with source:
+                    copy_limited(source, xml, budget)
+                reports.append((f'{name}/{member_name}' if member_name else name, xml.getvalue()))
+        return reports
+    except CORRUPT_ERRORS as e:
+        raise RejectedAttachment('corrupt', str(e) or type(e).__name__)
+    finally:
+        decompressed_bytes_total.inc(budget.size)
+
+
+def xml_name(name):
+    # File name of the decompressed report of a gzip or plain attachment
+    name = os.path.splitext(name)[0] if name.endswith(('.gz', '.zip')) else name
+    return name if name.endswith('.xml') else name + '.xml'
+
+
+def extract_file(file_path, target_directory):
+    """Decompress a zip or gzip file into `target_directory`, within the limits.
+
+    Members are written to a temporary name and renamed once complete. A
+    rejected file leaves nothing behind in the target directory.
+    """
+    name = os.path.basename(file_path)
+    budget = Budget(os.path.getsize(file_path))
+    written = []
+    try:
+        with stage_seconds.timer(stage='decompress'), open(file_path, 'rb') as f:
+            for member_name, source in open_members(f, budget.compressed_size):
+                if member_name is None:
+                    member_name = xml_name(name)
+                target_path = os.path.join(target_directory, os.path.basename(member_name))
+                written.append(target_path + '.part')
+                with source, open(target_path + '.part', 'wb') as target:
+                    copy_limited(source, target, budget)
+                os.replace(target_path + '.part', target_path)
+                written[-1] = target_path
+    except (RejectedAttachment,) + CORRUPT_ERRORS as e:
+        for path in written:
+            if os.path.exists(path):
+                os.remove(path)
+        if isinstance(e, RejectedAttachment):
+            raise
+        raise RejectedAttachment('corrupt', str(e) or type(e).__name__)
+    finally:
+        decompressed_bytes_total.inc(budget.size)
+    return written
+
+
+def quarantine(name, error, content=None, file_path=None):
+    """Keep a rejected attachment in QUARANTINE_FOLDER, next to a note of why it was rejected."""
+    rejections_total.inc(reason=error.reason)
+    os.makedirs(QUARANTINE_FOLDER, exist_ok=True)
+    target_path = os.path.join(QUARANTINE_FOLDER, f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}-{os.path.basename(name)}')
+    if file_path:
+        shutil.move(file_path, target_path)
+    else:
+        with open(target_path, 'wb') as f:
+            f.write(content)
+    with open(target_path + '.reason', 'w') as f:
+        f.write(f'{error.reason}: {error}\n')
+    logger.warning('Quarantined %s (%s): %s', name, error.reason, error)
+    return target_path
+
+
+def rejection_counts():
+    return {reason: rejections_total.value(reason=reason) for reason in REASONS}
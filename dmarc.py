@@ -0,0 +1,98 @@
+"""Command line for cron jobs and scripts, without the web stack.
+
+    python dmarc.py ingest [--source imap|graph|none]
+    python dmarc.py query domains|aggregates|rollups|senders [options]
+
+Queries print JSON. Only the modules a command needs are imported, Flask,
+msal and matplotlib never are, requests only for a Graph download or an
+RDAP lookup.
+"""
+import sys, json, time, argparse, logging
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Before the imports below, they read their settings when they are loaded
+load_dotenv()
+
+logger = logging.getLogger('dmarc')
+
+
+def date_arg(value):
+    # Normalised to 'YYYY-MM-DD' like the report filters of the web pages
+    return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+def ingest(args):
+    from ingest import ingest_from
+    from mail_sources import mail_source
+    source = None if args.source == 'none' else mail_source(args.source)
+    from report_store import store
+    started = time.perf_counter()
+    if args.profile:
+        from profiling import profiled
+        with profiled('ingest'):
+            ingest_from(source, workers=args.workers)
+    else:
+        ingest_from(source, workers=args.workers)
+    logger.info('Ingest finished in %.1f s, %d reports stored', time.perf_counter() - started, len(store))
+
+
+def query(args):
+    from report_store import store, FAILURE_TABLES, aggregate_summary, recent_rollups
+    # Read only, files waiting in the spool folders are left for the next ingest
+    store.load()
+    if args.query == 'domains':
+        result = store.domains()
+    elif args.query == 'aggregates':
+        result = aggregate_summary(store, args.domain, args.start_date, args.end_date)
+    elif args.query == 'rollups':
+        result = recent_rollups(store, args.days, args.domain)
+    else:
+        column = dict((name, column) for name, column, _ in FAILURE_TABLES).get(args.column, args.column)
+        total, groups = store.failed_groups(column, args.domain, args.start_date, args.end_date, limit=args.limit)
+        result = {'column': column, 'total': total, 'senders': groups}
+    json.dump(result, sys.stdout, indent=2, default=str)
+    sys.stdout.write('\n')
+
+
+def main(argv=None):
+    from mail_sources import SOURCES, MAIL_SOURCE
+    from report_store import FAILURE_TABLES, RESULT_COLUMNS
+    parser = argparse.ArgumentParser(prog='dmarc', description='Import and query DMARC aggregate reports')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = commands.add_parser('ingest', help='download new report mails and import them')
+    ingest_parser.add_argument('--source', choices=list(SOURCES) + ['none'], default=MAIL_SOURCE,
+                               help='mailbox to download from (default: MAIL_SOURCE or imap), none only imports the spool folders')
+    ingest_parser.add_argument('--workers', type=int, default=None, help='number of parser processes (default: CPU count)')
+    ingest_parser.add_argument('--profile', action='store_true', help='save a profile of the run to PROFILE_FOLDER')
+    ingest_parser.set_defaults(function=ingest)
+
+    query_parser = commands.add_parser('query', help='print report statistics as JSON')
+    queries = query_parser.add_subparsers(dest='query', required=True)
+    queries.add_parser('domains', help='domains with reports')
+    for name, description in [('aggregates', 'records and messages per result'), ('senders', 'failing senders, most messages first')]:
+        subparser = queries.add_parser(name, help=description)
+        subparser.add_argument('--domain')
+        subparser.add_argument('--start-date', type=date_arg, help='YYYY-MM-DD, together with --end-date')
+        subparser.add_argument('--end-date', type=date_arg, help='YYYY-MM-DD')
+    senders_parser = queries.choices['senders']
+    senders_parser.add_argument('--column', default='spf', choices=[name for name, _, _ in FAILURE_TABLES] + RESULT_COLUMNS,
+                                help='failure table or result column (default: spf)')
+    senders_parser.add_argument('--limit', type=int, default=20)
+    rollups_parser = queries.add_parser('rollups', help='daily pass and fail counts per domain')
+    rollups_parser.add_argument('--days', type=int, default=7)
+    rollups_parser.add_argument('--domain')
+    query_parser.set_defaults(function=query)
+
+    args = parser.parse_args(argv)
+    if (getattr(args, 'start_date', None) is None) != (getattr(args, 'end_date', None) is None):
+        parser.error('--start-date and --end-date go together')
+
+    from metrics import configure_logging
+    configure_logging()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+from datetime import datetime
+
+try:
+    from lxml import etree as ET
+    LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    LXML = False
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2] if isinstance(tag, str) else tag
+
+
+def child_elements(element):
+    # Direct children by local name, the first occurrence wins like findtext
+    children = {}
+    if element is not None:
+        for child in element:
+            children.setdefault(local_name(child.tag), child)
+    return children
+
+
+def child_text(children, name):
+    child = children.get(name)
+    if child is None:
+        return None
+    return child.text or ''
+
+
+def format_date(timestamp):
+    return datetime.utcfromtimestamp(int(timestamp)).strftime('%Y-%m-%d')
+
+
+def build_record(element):
+    record = child_elements(element)
+    row = child_elements(record.get('row'))
+    policy_evaluated = child_elements(row.get('policy_evaluated'))
+    identifiers = child_elements(record.get('identifiers'))
+    auth_results = child_elements(record.get('auth_results'))
+    dkim = child_elements(auth_results.get('dkim'))
+    spf = child_elements(auth_results.get('spf'))
+    return {
+        'source_ip': child_text(row, 'source_ip'),
+        'owner': None,
+        'count': int(child_text(row, 'count')),
+        'policy_evaluated_disposition': child_text(policy_evaluated, 'disposition'),
+        'policy_evaluated_dkim': child_text(policy_evaluated, 'dkim'),
+        'policy_evaluated_spf': child_text(policy_evaluated, 'spf'),
+        'envelope_to': child_text(identifiers, 'envelope_to'),
+        'header_from': child_text(identifiers, 'header_from'),
+        'envelope_from': child_text(identifiers, 'envelope_from'),
+        'auth_results_dkim_domain': child_text(dkim, 'domain'),
+        'auth_results_dkim_result': child_text(dkim, 'result'),
+        'auth_results_spf_domain': child_text(spf, 'domain'),
+        'auth_results_spf_result': child_text(spf, 'result')
+    }
+
+
+def read_metadata(element, header):
+    metadata = child_elements(element)
+    date_range = child_elements(metadata.get('date_range'))
+    header['organization'] = child_text(metadata, 'org_name')
+    header['report_id'] = child_text(metadata, 'report_id')
+    header['begin'] = child_text(date_range, 'begin')
+    header['end'] = child_text(date_range, 'end')
+
+
+def read_policy(element, header):
+    policy = child_elements(element)
+    for name in ('domain', 'adkim', 'aspf', 'p', 'sp', 'pct', 'fo'):
+        header[name] = child_text(policy, name)
+
+
+def iterparse(source):
+    if LXML:
+        # lxml filters the events in C, so only the three interesting elements come back. libxml2's
+        # depth and text size limits stay on, reports are untrusted and never come near them
+        return ET.iterparse(source, events=('end',), tag=('{*}record', '{*}report_metadata', '{*}policy_published'),
+                            resolve_entities=False, no_network=True)
+    return ET.iterparse(source, events=('start', 'end'))
+
+
+def iter_records(source, header):
+    """Yield the records of a DMARC aggregate report one at a time.
+
+    `source` is a file path or binary file object. The report metadata is
+    stored in `header` as soon as it has been read, which is before the
+    first record for schema-conforming reports. Every consumed element is
+    cleared so memory stays flat regardless of the report size.
+    """
+    root = None
+    for event, element in iterparse(source):
+        if event == 'start':
+            if root is None:
+                root = element
+            continue
+        tag = local_name(element.tag)
+        if tag == 'record':
+            yield build_record(element)
+        elif tag == 'report_metadata':
+            read_metadata(element, header)
+        elif tag == 'policy_published':
+            read_policy(element, header)
+        else:
+            continue
+        element.clear()
+        # Drop the references the tree keeps to already processed elements
+        if LXML:
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        else:
+            root.clear()
+
+
+def report_header(header):
+    return {
+        'organization': header.get('organization'),
+        'domain': header.get('domain'),
+        'report_id': header.get('report_id'),
+        'date_range': {
+            'begin': format_date(header['begin']),
+            'end': format_date(header['end'])
+        },
+        'adkim': header.get('adkim'),
+        'aspf': header.get('aspf'),
+        'p': header.get('p'),
+        'sp': header.get('sp'),
+        'pct': int(header['pct']),
+        'fo': header.get('fo'),
+        'records': []
+    }
+
+
+def parse_dmarc_report(source):
+    header = {}
+    records = list(iter_records(source, header))
+    report = report_header(header)
+    report['records'] = records
+    return report
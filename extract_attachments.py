@@ -1,35 +1,318 @@
-import os
-from imbox import Imbox
-import traceback
+import os, re, json, base64, quopri, logging, imaplib, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.header import decode_header, make_header
 from dotenv import load_dotenv
+from ingest import SpoolSink
+from metrics import configure_logging, timed_stage, messages_total, attachments_total
 
-def extract_attachments():
+load_dotenv()
 
-    host = os.getenv("EMAIL_HOST")
-    username = os.getenv("EMAIL_ADDRESS")
-    password = os.getenv("EMAIL_PASSWORD")
-    download_folder = "./downloaded_mails"
+# Last UID fetched per mailbox, together with the UIDVALIDITY it belongs to
+CHECKPOINT_FILE = os.getenv('IMAP_CHECKPOINT_FILE', 'imap_checkpoint.json')
+IMAP_FOLDER = os.getenv('IMAP_FOLDER', 'INBOX')
+IMAP_SEARCH = os.getenv('IMAP_SEARCH', 'SUBJECT "report domain"')
+# Messages per FETCH command, and connections sharing the batches of a large backlog
+IMAP_BATCH_SIZE = int(os.getenv('IMAP_BATCH_SIZE', 50))
+IMAP_CONNECTIONS = int(os.getenv('IMAP_CONNECTIONS', 1))
+
+OPEN, CLOSE = object(), object()
+TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+logger = logging.getLogger(__name__)
+
+
+def split_tokens(data):
+    tokens = []
+    position = 0
+    while True:
+        match = TOKEN.match(data, position)
+        if not match or match.end() == position:
+            return tokens
+        position = match.end()
+        if match.group(1):
+            tokens.append(OPEN)
+        elif match.group(2):
+            tokens.append(CLOSE)
+        elif match.group(3) is not None:
+            tokens.append(re.sub(rb'\\(.)', rb'\1', match.group(3)))
+        else:
+            atom = match.group(4)
+            tokens.append(None if atom.upper() == b'NIL' else atom)
+
+
+def parse_response(data):
+    """Nested lists of a FETCH response as imaplib returns it.
+
+    Literals arrive as (prefix ending in {size}, data) tuples and are
+    spliced in as strings.
+    """
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            tokens.extend(split_tokens(re.sub(rb'\{\d+\}$', b'', item[0])))
+            tokens.append(item[1])
+        elif item:
+            tokens.extend(split_tokens(item))
+    stack = [[]]
+    for token in tokens:
+        if token is OPEN:
+            stack.append([])
+        elif token is CLOSE:
+            if len(stack) > 1:
+                inner = stack.pop()
+                stack[-1].append(inner)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def fetch_items(data):
+    # {uid: {b'BODYSTRUCTURE': ..., b'BODY[2]': ...}} of a UID FETCH response
+    items = {}
+    for value in parse_response(data):
+        if isinstance(value, list):
+            fields = {value[i].upper(): value[i + 1] for i in range(0, len(value) - 1, 2) if isinstance(value[i], bytes)}
+            if b'UID' in fields:
+                items[int(fields.pop(b'UID'))] = fields
+    return items
+
+
+def parameter(params, name):
+    if not isinstance(params, list):
+        return None
+    for i in range(0, len(params) - 1, 2):
+        if isinstance(params[i], bytes) and params[i].lower() == name:
+            return params[i + 1]
+    return None
+
+
+def decode_filename(value):
+    filename = value.decode('utf-8', 'replace')
+    try:
+        # Encoded words like =?utf-8?q?...?=
+        filename = str(make_header(decode_header(filename)))
+    except Exception:
+        pass
+    return os.path.basename(filename.replace('\\', '/'))
+
+
+def attachment_parts(structure, section=''):
+    """(section, filename, transfer encoding) of every part with a file name in a BODYSTRUCTURE."""
+    if isinstance(structure[0], list):
+        # Multipart: the child bodies come first, then the subtype and the extension data
+        parts = []
+        for number, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            parts.extend(attachment_parts(child, f'{section}.{number}' if section else str(number)))
+        return parts
+    media_type = (structure[0] or b'').lower()
+    subtype = (structure[1] or b'').lower()
+    if media_type == b'message' and subtype == b'rfc822':
+        # Forwarded mails: the body of the embedded message follows its envelope, its parts are numbered N.1, N.2, ...
+        body = structure[8] if len(structure) > 8 else None
+        if not isinstance(body, list) or not body:
+            return []
+        section = section or '1'
+        return attachment_parts(body, section if isinstance(body[0], list) else f'{section}.1')
+    # md5, disposition, language, location follow the body fields, text parts also carry a line count
+    extension = 8 if media_type == b'text' else 7
+    disposition = structure[extension + 1] if len(structure) > extension + 1 else None
+    filename = None
+    if isinstance(disposition, list) and len(disposition) > 1:
+        filename = parameter(disposition[1], b'filename')
+    if filename is None:
+        filename = parameter(structure[2], b'name')
+    if not filename:
+        return []
+    return [(section or '1', decode_filename(filename), (structure[5] or b'7bit').lower())]
+
+
+def decode_part(data, encoding):
+    if encoding == b'base64':
+        return base64.b64decode(data)
+    if encoding == b'quoted-printable':
+        return quopri.decodestring(data)
+    return data
 
-    if not os.path.isdir(download_folder):
-        os.makedirs(download_folder, exist_ok=True)
 
-    mail = Imbox(host, username=username, password=password, ssl=True, ssl_context=None, starttls=False)
-    #messages = mail.messages(sent_from=["noreply-dmarc-support@google.com", "dmarcreport@microsoft.com", "dmarc@infomaniak.com", "dmarc_reports@reports.emailsrvr.com"])
-    messages = mail.messages(subject="report domain", unread=True)
-    for (uid, message) in messages:
-        mail.mark_seen(uid)
+class Checkpoint:
+    """Highest UID fetched per mailbox, only valid for the UIDVALIDITY it was taken under."""
 
-        for idx, attachment in enumerate(message.attachments):
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.mailboxes = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
             try:
-                att_fn = attachment.get('filename')
-                download_path = f"{download_folder}/{att_fn}"
-                print(download_path)
-                with open(download_path, "wb") as fp:
-                    fp.write(attachment.get('content').read())
-            except:
-                print(traceback.print_exc())
+                with open(path, 'r') as f:
+                    self.mailboxes = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning('Starting over, unreadable IMAP checkpoint %s: %s', path, e)
 
-    mail.logout()
+    def last_uid(self, mailbox, uidvalidity):
+        entry = self.mailboxes.get(mailbox)
+        if not entry or entry['uidvalidity'] != uidvalidity:
+            return 0
+        return entry['uid']
+
+    def update(self, mailbox, uidvalidity, uid):
+        with self.lock:
+            self.mailboxes[mailbox] = {'uidvalidity': uidvalidity, 'uid': uid}
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.mailboxes, f)
+            os.replace(tmp_path, self.path)
+
+
+class UIDValidityChanged(RuntimeError):
+    pass
+
+
+def connect():
+    host = os.getenv("EMAIL_HOST")
+    port = int(os.getenv("EMAIL_PORT", 993))
+    if os.getenv("EMAIL_SSL", "true").lower() == "false":
+        mail = imaplib.IMAP4(host, port)
+    else:
+        mail = imaplib.IMAP4_SSL(host, port)
+    mail.login(os.getenv("EMAIL_ADDRESS"), os.getenv("EMAIL_PASSWORD"))
+    # EXAMINE, so nothing is marked as read
+    status, data = mail.select(f'"{IMAP_FOLDER}"', readonly=True)
+    if status != 'OK':
+        raise RuntimeError(f'Cannot open mailbox {IMAP_FOLDER}: {data}')
+    uidvalidity = int(mail.response('UIDVALIDITY')[1][0])
+    return mail, uidvalidity
+
+
+def new_uids(mail, last_uid):
+    status, data = mail.uid('SEARCH', f'UID {last_uid + 1}:*', IMAP_SEARCH)
+    if status != 'OK':
+        raise RuntimeError(f'IMAP search failed: {data}')
+    # n:* always matches the newest message, even when its UID is below n
+    return sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+
+
+@timed_stage('fetch')
+def fetch_batch(mail, uids, sink, job=None):
+    # One FETCH for the structure of the batch, then one per distinct set of attachment parts
+    uid_set = ','.join(map(str, uids)).encode()
+    status, data = mail.uid('FETCH', uid_set, '(UID BODYSTRUCTURE)')
+    if status != 'OK':
+        raise RuntimeError(f'IMAP fetch failed: {data}')
+    layouts = {}
+    for uid, fields in fetch_items(data).items():
+        parts = attachment_parts(fields[b'BODYSTRUCTURE'])
+        if parts:
+            layouts.setdefault(tuple(section for section, _, _ in parts), []).append((uid, parts))
+    saved = 0
+    for sections, messages in layouts.items():
+        uid_set = ','.join(str(uid) for uid, _ in messages).encode()
+        items = '(UID ' + ' '.join(f'BODY.PEEK[{section}]' for section in sections) + ')'
+        status, data = mail.uid('FETCH', uid_set, items)
+        if status != 'OK':
+            raise RuntimeError(f'IMAP fetch failed: {data}')
+        bodies = fetch_items(data)
+        for uid, parts in messages:
+            for section, filename, encoding in parts:
+                content = bodies.get(uid, {}).get(f'BODY[{section}]'.encode())
+                if content is None:
+                    logger.warning('Missing part %s of message %s', section, uid)
+                    continue
+                filename = filename or f'{uid}-{section}'
+                logger.debug('Fetched %s from message %s', filename, uid)
+                sink.save(filename, decode_part(content, encoding))
+                saved += 1
+                attachments_total.inc(source='imap')
+                if job:
+                    job.count('attachments')
+    messages_total.inc(len(uids), source='imap')
+    if job:
+        job.count('messages', len(uids))
+    return saved
+
+
+def extract_attachments(job=None, connections=IMAP_CONNECTIONS, batch_size=IMAP_BATCH_SIZE, checkpoint_path=CHECKPOINT_FILE, sink=None):
+    """Download the attachments of the report mails received since the last run.
+
+    Only the attachment parts are fetched, with BODY.PEEK so the mails stay
+    unread. The checkpoint moves past a batch once it and every batch before
+    it are stored, a failed run starts again at the first missing batch.
+    The attachments go to `sink`, by default they are written to the
+    download folder. `job` counts the messages and attachments when run as
+    a background job.
+    """
+    sink = sink or SpoolSink()
+    checkpoint = Checkpoint(checkpoint_path)
+    mailbox = f'{os.getenv("EMAIL_ADDRESS")}@{os.getenv("EMAIL_HOST")}/{IMAP_FOLDER}'
+    mail, uidvalidity = connect()
+    try:
+        uids = new_uids(mail, checkpoint.last_uid(mailbox, uidvalidity))
+        batches = [uids[i:i + batch_size] for i in range(0, len(uids), batch_size)]
+        logger.info('%d new messages in %s, %d batches', len(uids), IMAP_FOLDER, len(batches))
+        if not batches:
+            return 0
+        if connections <= 1 or len(batches) == 1:
+            saved = 0
+            for batch in batches:
+                saved += fetch_batch(mail, batch, sink, job)
+                sink.flush()
+                checkpoint.update(mailbox, uidvalidity, batch[-1])
+            return saved
+    finally:
+        mail.logout()
+
+    # Every worker thread opens its own connection, the checkpoint only advances over a gapless prefix
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def run_batch(batch):
+        if not hasattr(local, 'mail'):
+            mail, worker_uidvalidity = connect()
+            with opened_lock:
+                opened.append(mail)
+            # Only kept once it is known to match, the UIDs of the batches belong to the first connection's mailbox state
+            if worker_uidvalidity != uidvalidity:
+                raise UIDValidityChanged('UIDVALIDITY changed during the download')
+            local.mail = mail
+        saved = fetch_batch(local.mail, batch, sink, job)
+        sink.flush()
+        return saved
+
+    saved = 0
+    done = set()
+    next_batch = 0
+    error = None
+    with ThreadPoolExecutor(max_workers=min(connections, len(batches))) as executor:
+        futures = {executor.submit(run_batch, batch): index for index, batch in enumerate(batches)}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                saved += future.result()
+            except Exception as e:
+                logger.exception('Batch %d failed', futures[future])
+                error = error or e
+                if isinstance(e, UIDValidityChanged):
+                    # None of the remaining UIDs are valid any more, the next run starts over
+                    for other in futures:
+                        other.cancel()
+                continue
+            done.add(futures[future])
+            if next_batch in done:
+                while next_batch in done:
+                    next_batch += 1
+                checkpoint.update(mailbox, uidvalidity, batches[next_batch - 1][-1])
+    for connection in opened:
+        try:
+            connection.logout()
+        except Exception:
+            pass
+    if error:
+        raise error
+    return saved
 
 if __name__ == "__main__":
-    extract_attachments()
\ No newline at end of file
+    configure_logging()
+    extract_attachments()
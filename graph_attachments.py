@@ -0,0 +1,172 @@
+import os, json, base64, logging, hashlib
+from concurrent.futures import ThreadPoolExecutor
+import requests, dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from ingest import SpoolSink
+from metrics import timed_stage, messages_total, attachments_total
+
+dotenv.load_dotenv()
+
+# Delta link of the last complete sync per mailbox folder, the next run only transfers what changed since,
+# and the messages of the folder already downloaded, which come back in the delta when they are read
+DELTA_FILE = os.getenv('GRAPH_DELTA_FILE', 'graph_delta.json')
+# Mail folders to sync, comma separated. Delta queries work per folder, the whole mailbox cannot be synced at once
+GRAPH_FOLDERS = [folder.strip() for folder in os.getenv('GRAPH_FOLDER', 'inbox').split(',') if folder.strip()]
+GRAPH_SUBJECT = os.getenv('GRAPH_SUBJECT', 'report domain')
+GRAPH_WORKERS = int(os.getenv('GRAPH_WORKERS', 4))
+GRAPH_RETRIES = int(os.getenv('GRAPH_RETRIES', 5))
+GRAPH_TIMEOUT = (3.05, float(os.getenv('GRAPH_TIMEOUT', 30)))
+GRAPH_PAGE_SIZE = int(os.getenv('GRAPH_PAGE_SIZE', 100))
+
+logger = logging.getLogger(__name__)
+
+
+def create_session(pool_size=GRAPH_WORKERS, retries=GRAPH_RETRIES):
+    # Graph throttles with 429 and Retry-After, urllib3 waits as long as the header asks
+    retry = Retry(total=retries, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',), respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def delta_url(endpoint, folder):
+    # Delta queries work per mail folder, e.g. .../me/messages -> .../me/mailFolders/inbox/messages/delta
+    base = endpoint.rstrip('/')
+    if base.endswith('/messages'):
+        base = base[:-len('/messages')]
+    return f'{base}/mailFolders/{folder}/messages/delta'
+
+
+def message_key(message_id):
+    return hashlib.sha1(message_id.encode()).hexdigest()[:16]
+
+
+class SyncState:
+    def __init__(self, path=DELTA_FILE):
+        self.path = path
+        self.folders = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.folders = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning('Starting a full sync, unreadable sync state %s: %s', path, e)
+
+    def get(self, url):
+        state = self.folders.get(url, {})
+        return state.get('link'), set(state.get('seen', []))
+
+    def set(self, url, link, seen):
+        self.folders[url] = {'link': link, 'seen': sorted(seen)}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.folders, f)
+        os.replace(tmp_path, self.path)
+
+
+def get_json(session, url, headers, params=None):
+    response = session.get(url, headers=headers, params=params, timeout=GRAPH_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def changed_messages(session, headers, url, link=None):
+    """Messages added or changed since `link`, ids of the removed ones, the delta link for the next run
+    and whether the round was a full sync.
+
+    Without a link every message of the folder is listed. Only the fields
+    needed to pick the report mails are requested.
+    """
+    messages = []
+    removed = []
+    if link:
+        next_url, params = link, None
+    else:
+        next_url, params = url, {'$select': 'subject,hasAttachments'}
+    page_headers = dict(headers, Prefer=f'odata.maxpagesize={GRAPH_PAGE_SIZE}')
+    while True:
+        try:
+            page = get_json(session, next_url, page_headers, params)
+        except requests.HTTPError as e:
+            if link and e.response is not None and e.response.status_code == 410:
+                # The sync state expired on the server, start over
+                logger.info('Delta link expired, starting a full sync')
+                return changed_messages(session, headers, url)
+            raise
+        for message in page.get('value', []):
+            if '@removed' in message:
+                removed.append(message['id'])
+            else:
+                messages.append(message)
+        if '@odata.nextLink' in page:
+            next_url, params = page['@odata.nextLink'], None
+        else:
+            return messages, removed, page.get('@odata.deltaLink'), not link
+
+
+def is_report(message, subject=GRAPH_SUBJECT):
+    return bool(message.get('hasAttachments')) and subject.lower() in (message.get('subject') or '').lower()
+
+
+@timed_stage('fetch')
+def save_attachments(session, headers, endpoint, message, sink, job=None):
+    saved = 0
+    # Attachments come with their content, large ones are split over several pages
+    next_url = f"{endpoint.rstrip('/')}/{message['id']}/attachments"
+    while next_url:
+        page = get_json(session, next_url, headers)
+        for attachment in page.get('value', []):
+            if attachment.get('@odata.type', '#microsoft.graph.fileAttachment') != '#microsoft.graph.fileAttachment':
+                continue
+            file_name = os.path.basename((attachment.get('name') or attachment['id']).replace('\\', '/'))
+            sink.save(file_name, base64.b64decode(attachment.get('contentBytes') or ''))
+            logger.debug('Saved attachment: %s', file_name)
+            saved += 1
+            attachments_total.inc(source='graph')
+            if job:
+                job.count('attachments')
+        next_url = page.get('@odata.nextLink')
+    messages_total.inc(source='graph')
+    if job:
+        job.count('messages')
+    return saved
+
+
+def download_attachments(token, endpoint, job=None, workers=GRAPH_WORKERS, delta_path=DELTA_FILE, sink=None, folders=GRAPH_FOLDERS):
+    """Download the attachments of the report mails that arrived in `folders` since the last run.
+
+    The delta link of a folder is only stored once every attachment of the
+    folder is saved, so a failed run is repeated the next time. The
+    attachments go to `sink`, by default they are written to the download
+    folder.
+    """
+    sink = sink or SpoolSink()
+    headers = {"Authorization": f"Bearer {token}"}
+    session = create_session(max(1, workers))
+    state = SyncState(delta_path)
+    saved = 0
+    for folder in folders:
+        url = delta_url(endpoint, folder)
+        previous_link, seen = state.get(url)
+        messages, removed, link, full = changed_messages(session, headers, url, previous_link)
+        reports = [message for message in messages if is_report(message) and message_key(message['id']) not in seen]
+        logger.info('%s: %d new or changed messages, %d report mails', folder, len(messages), len(reports))
+
+        if reports:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                for count in executor.map(lambda message: save_attachments(session, headers, endpoint, message, sink, job), reports):
+                    saved += count
+        sink.flush()
+        # Only messages still in the folder can come back in a later round. A full sync lists all of them,
+        # otherwise the round names the ones that left
+        if full:
+            seen &= set(message_key(message['id']) for message in messages)
+        seen -= set(message_key(message_id) for message_id in removed)
+        seen.update(message_key(message['id']) for message in reports)
+        if link:
+            state.set(url, link, seen)
+    return saved
@@ -0,0 +1,354 @@
+import os, io, logging, argparse, threading
+from concurrent.futures import ProcessPoolExecutor
+from dmarc_parser import parse_dmarc_report
+from rdap import enrich_reports
+from report_store import store, report_key, ContentIndex
+from decompression import read_members, quarantine, xml_name, RejectedAttachment
+from unzip_attachments import unzip_files
+from metrics import configure_logging, stage_seconds, parse_errors_total, reports_total, records_total, content_index_digests
+
+EXTRACTED_FOLDER = './extracted_files'
+DOWNLOAD_FOLDER = './downloaded_mails'
+# Write downloaded attachments to DOWNLOAD_FOLDER and import them from there, instead of parsing them in memory
+INGEST_SPOOL = os.getenv('INGEST_SPOOL', 'false').lower() == 'true'
+# Attachments parsed and stored together in memory
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 200))
+# Attachments and decompressed reports held in memory before they are parsed and stored
+INGEST_BATCH_BYTES = int(os.getenv('INGEST_BATCH_BYTES', 64 * 1024 * 1024))
+# One import at a time within the process, the page requests and the background jobs share the folder
+ingest_lock = threading.Lock()
+# Digests of the attachments and reports imported before, copies are dropped unopened
+content_index = ContentIndex()
+content_index_digests.set_function(lambda: len(content_index))
+
+logger = logging.getLogger(__name__)
+
+
+def list_report_files(folder=EXTRACTED_FOLDER):
+    if not os.path.isdir(folder):
+        return []
+    # Sorted so that every run merges the batch in the same order
+    return [os.path.join(folder, filename) for filename in sorted(os.listdir(folder)) if filename.endswith('.xml')]
+
+
+def parse_report_file(file_path):
+    try:
+        return parse_dmarc_report(file_path)
+    except Exception:
+        logger.warning('Error parsing DMARC report %s', file_path, exc_info=True)
+        return None
+
+
+def parse_source(source):
+    name, xml = source
+    try:
+        return parse_dmarc_report(io.BytesIO(xml))
+    except Exception:
+        logger.warning('Error parsing DMARC report %s', name, exc_info=True)
+        return None
+
+
+def new_sources(attachments, job=None):
+    """(attachment digest, sources) of every attachment in `attachments` that is not in the content index.
+
+    Sources are the (name, XML, digest, attachment digest) of its reports.
+    Known attachments are dropped before they are decompressed, known XML
+    before it is parsed, copies within the batch count as known too.
+    Attachments over the decompression limits are quarantined. One
+    attachment is decompressed at a time, as the caller asks for it.
+    """
+    batch = set()
+    for name, content in attachments:
+        digest = content_index.digest(content)
+        if digest in content_index or digest in batch:
+            content_index.skip('attachments', len(content))
+            if job:
+                job.count('duplicates')
+            continue
+        batch.add(digest)
+        try:
+            members = read_members(name, content)
+        except RejectedAttachment as e:
+            quarantine(name, e, content=content)
+            if job:
+                job.count('rejected')
+            continue
+        sources = []
+        for source_name, xml in members:
+            # A plain XML attachment is its own report
+            xml_digest = content_index.digest(xml)
+            if xml_digest != digest and (xml_digest in content_index or xml_digest in batch):
+                content_index.skip('reports', len(xml))
+                if job:
+                    job.count('duplicates')
+                continue
+            batch.add(xml_digest)
+            sources.append((source_name, xml, xml_digest, digest))
+        yield digest, sources
+
+
+def parse_files(file_paths, workers=None):
+    workers = min(workers or os.cpu_count() or 1, len(file_paths))
+    with stage_seconds.timer(stage='parse'):
+        if workers <= 1:
+            results = [parse_report_file(file_path) for file_path in file_paths]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # map keeps the input order, so the merge is deterministic
+                chunksize = max(1, len(file_paths) // (workers * 4))
+                results = list(executor.map(parse_report_file, file_paths, chunksize=chunksize))
+    parse_errors_total.inc(results.count(None))
+    return [(file_path, report) for file_path, report in zip(file_paths, results) if report is not None]
+
+
+def load_reports(folder=EXTRACTED_FOLDER, workers=None, job=None, wait=False):
+    # Picks up reports and digests appended by another process, e.g. the ingest CLI, without re-reading the archive
+    store.refresh()
+    content_index.refresh()
+    # Without `wait` a request does not queue up behind an import that is already running
+    if not ingest_lock.acquire(blocking=wait):
+        return []
+    try:
+        return import_reports(folder, workers, job)
+    finally:
+        ingest_lock.release()
+
+
+def store_new_reports(reports, job=None):
+    # Duplicates are dropped before enrichment, so they cost no RDAP lookups
+    new_reports = []
+    keys = set()
+    for report in reports:
+        key = report_key(report)
+        if key not in store.index and key not in keys:
+            keys.add(key)
+            new_reports.append(report)
+    if new_reports:
+        # Owners are resolved for the whole batch at once, after parsing
+        enrich_reports(new_reports, job=job)
+        with stage_seconds.timer(stage='store'):
+            store.append(new_reports)
+        reports_total.inc(len(new_reports))
+        records_total.inc(sum(len(report['records']) for report in new_reports))
+    if job:
+        job.count('reports', len(new_reports))
+    return new_reports
+
+
+def import_reports(folder, workers, job):
+    file_paths = list_report_files(folder)
+    digests = {}
+    # The digests of `digests`, copies within the folder are found without a scan
+    seen = set()
+    for file_path in file_paths:
+        with open(file_path, 'rb') as f:
+            xml = f.read()
+        digest = content_index.digest(xml)
+        if digest in content_index or digest in seen:
+            # Imported before, nothing to parse
+            content_index.skip('reports', len(xml))
+            if job:
+                job.count('duplicates')
+            os.remove(file_path)
+        else:
+            digests[file_path] = digest
+            seen.add(digest)
+    if not digests:
+        content_index.save()
+        return []
+    parsed = parse_files(list(digests), workers)
+    # Files that failed to parse are kept for inspection in the quarantine folder, not parsed again on every import
+    parsed_paths = set(file_path for file_path, _ in parsed)
+    for file_path in digests:
+        if file_path not in parsed_paths:
+            quarantine(os.path.basename(file_path), RejectedAttachment('invalid', 'not a readable DMARC aggregate report'), file_path=file_path)
+            if job:
+                job.count('rejected')
+    new_reports = store_new_reports([report for _, report in parsed], job)
+    content_index.add(digests[file_path] for file_path, _ in parsed)
+    content_index.save()
+    # Only delete the source files once their reports are stored
+    for file_path, _ in parsed:
+        os.remove(file_path)
+    logger.info('Imported %d new reports from %d files in %s, %d known files skipped',
+                len(new_reports), len(parsed), folder, len(file_paths) - len(digests))
+    return new_reports
+
+
+def store_sources(sources, opened, executor=None, workers=1, job=None):
+    # Parses and stores one round of new_sources, then marks the attachments and reports that were stored as known
+    with stage_seconds.timer(stage='parse'):
+        if executor is None:
+            results = [parse_source(source[:2]) for source in sources]
+        else:
+            chunksize = max(1, len(sources) // (workers * 4))
+            results = list(executor.map(parse_source, [source[:2] for source in sources], chunksize=chunksize))
+    parse_errors_total.inc(results.count(None))
+    new_reports = store_new_reports([report for report in results if report is not None], job)
+    # The mail is not fetched again once the sync state moves on, like import_reports the XML is kept in the quarantine folder
+    for source, report in zip(sources, results):
+        if report is None:
+            quarantine(xml_name(source[0]), RejectedAttachment('invalid', 'not a readable DMARC aggregate report'), content=source[1])
+            if job:
+                job.count('rejected')
+    # An attachment is only known once all of its reports parsed, a copy of a failed one is tried again
+    failed = {source[3] for source, report in zip(sources, results) if report is None}
+    content_index.add([source[2] for source, report in zip(sources, results) if report is not None]
+                      + [digest for digest in opened if digest not in failed])
+    return new_reports
+
+
+def import_attachments(attachments, workers=None, job=None):
+    """Parse and store the reports of (name, content) attachments without writing them to disk.
+
+    Decompressed reports are parsed and stored whenever they add up to
+    INGEST_BATCH_BYTES, so at most that much XML is held at a time.
+    """
+    if not attachments:
+        return []
+    new_reports = []
+    parsed = 0
+    with ingest_lock:
+        store.refresh()
+        content_index.refresh()
+        workers = min(workers or os.cpu_count() or 1, len(attachments))
+        # The worker processes are started on the first round that needs them and serve every round
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            sources, opened, size = [], [], 0
+            for digest, members in new_sources(attachments, job):
+                sources += members
+                opened.append(digest)
+                size += sum(len(source[1]) for source in members)
+                if size >= INGEST_BATCH_BYTES:
+                    new_reports += store_sources(sources, opened, executor, workers, job)
+                    parsed += len(sources)
+                    sources, opened, size = [], [], 0
+            if opened:
+                new_reports += store_sources(sources, opened, executor, workers, job)
+                parsed += len(sources)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        content_index.save()
+    logger.info('Imported %d new reports from %d attachments, %d reports parsed, %s skipped as known so far',
+                len(new_reports), len(attachments), parsed, content_index.skipped)
+    return new_reports
+
+
+class SpoolSink:
+    """Writes downloaded attachments to a folder, unzip_files and load_reports import them later.
+
+    Attachments survive a crash before they are imported, at the cost of
+    writing and reading every report twice more. Their digests are only
+    added to the content index by `imported`, after the import.
+    """
+
+    def __init__(self, folder=DOWNLOAD_FOLDER):
+        self.folder = folder
+        # Spooled file paths and their digests, until the file is imported
+        self.spooled = {}
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        content_index.refresh()
+
+    def save(self, name, content):
+        digest = content_index.digest(content)
+        # The digest keeps attachments of the same name apart, a copy that is already spooled is not written again
+        path = os.path.join(self.folder, f'{digest[:16]}-{name}')
+        if digest in content_index or os.path.exists(path):
+            content_index.skip('attachments', len(content))
+            return
+        # Written under a name unzip_files ignores, renamed once complete
+        tmp_path = f'{path}.{threading.get_ident()}.part'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.spooled[path] = digest
+
+    def flush(self):
+        content_index.save()
+
+    def imported(self):
+        # A file that left the folder was extracted and its reports imported, or it was quarantined
+        with self.lock:
+            done = [path for path in self.spooled if not os.path.exists(path)]
+            content_index.add([self.spooled.pop(path) for path in done])
+        content_index.save()
+
+
+class ReportSink:
+    """Imports downloaded attachments straight from memory, in batches of `batch_size` or `batch_bytes`.
+
+    The fetchers call flush before they record their progress, so nothing
+    is marked as fetched before its reports are stored.
+    """
+
+    def __init__(self, job=None, batch_size=INGEST_BATCH_SIZE, workers=None, batch_bytes=INGEST_BATCH_BYTES):
+        self.job = job
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.workers = workers
+        self.pending = []
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+        # A flush returns only after the attachments saved before it are stored, even if another thread took them
+        self.flush_lock = threading.Lock()
+
+    def save(self, name, content):
+        with self.lock:
+            self.pending.append((name, content))
+            self.pending_bytes += len(content)
+            full = len(self.pending) >= self.batch_size or self.pending_bytes >= self.batch_bytes
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                attachments, self.pending, self.pending_bytes = self.pending, [], 0
+            import_attachments(attachments, self.workers, self.job)
+
+
+def attachment_sink(job=None):
+    return SpoolSink() if INGEST_SPOOL else ReportSink(job)
+
+
+def ingest_from(source=None, job=None, workers=None):
+    """Download the new report mails of a mailbox source (see mail_sources.py) and import them.
+
+    Attachments are parsed in memory unless INGEST_SPOOL is set, the spool
+    folders are still imported to pick up files left behind by an earlier
+    run. Without a source only the spool folders are imported.
+    """
+    sink = None
+    if source is not None:
+        sink = attachment_sink(job)
+        source.download(job, sink=sink)
+    unzip_files(DOWNLOAD_FOLDER, EXTRACTED_FOLDER)
+    new_reports = load_reports(workers=workers, job=job, wait=True)
+    if isinstance(sink, SpoolSink):
+        sink.imported()
+    return new_reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import extracted DMARC aggregate reports into the report store')
+    parser.add_argument('--folder', default=EXTRACTED_FOLDER, help='folder containing the extracted XML reports')
+    parser.add_argument('--workers', type=int, default=None, help='number of parser processes (default: CPU count)')
+    parser.add_argument('--profile', action='store_true',
+                        help='save a profile of the import to PROFILE_FOLDER, use --workers 1 to include the parsing')
+    args = parser.parse_args()
+    configure_logging()
+    if args.profile:
+        from profiling import profiled
+        with profiled('ingest'):
+            load_reports(args.folder, args.workers, wait=True)
+    else:
+        load_reports(args.folder, args.workers, wait=True)
+    logger.info('%d reports stored', len(store))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import os, sys, csv, mmap, array, struct, bisect, logging, ipaddress, threading
+from metrics import configure_logging, rdap_lookups_total
+
+# CSV or TSV of networks and their owners, answers owner lookups without RDAP (off when empty)
+IP_OWNER_FILE = os.getenv('IP_OWNER_FILE', '')
+# Compiled form of IP_OWNER_FILE, rebuilt when that file changes and memory-mapped by every process
+IP_OWNER_INDEX = os.getenv('IP_OWNER_INDEX', 'ip_owners.idx')
+
+MAGIC = b'DMARCIP1'
+# Magic, byte order mark, source size and mtime, IPv4 ranges, IPv6 ranges, owners, owner name bytes
+HEADER = struct.Struct('=8sIQqIIII')
+BYTE_ORDER_MARK = 0x01020304
+
+logger = logging.getLogger(__name__)
+
+
+def read_ranges(path):
+    """{4: [(first, last, owner)], 6: [...]} of a CSV or TSV file, addresses as integers.
+
+    A row is a network in CIDR notation or a first and last address,
+    followed by other columns. The owner is the last non-empty column,
+    e.g. the AS description of an IP-to-ASN table. Rows that do not start
+    with an address, like a header line, are skipped.
+    """
+    ranges = {4: [], 6: []}
+    skipped = 0
+    with open(path, 'r', newline='', encoding='utf-8', errors='replace') as f:
+        delimiter = '\t' if '\t' in f.readline() else ','
+        f.seek(0)
+        for row in csv.reader(f, delimiter=delimiter):
+            fields = [field.strip() for field in row]
+            if not fields or not fields[0] or fields[0].startswith('#'):
+                continue
+            try:
+                if '/' in fields[0]:
+                    network = ipaddress.ip_network(fields[0], strict=False)
+                    first, last, rest = network.network_address, network.broadcast_address, fields[1:]
+                else:
+                    first, last, rest = ipaddress.ip_address(fields[0]), ipaddress.ip_address(fields[1]), fields[2:]
+            except (ValueError, IndexError):
+                skipped += 1
+                continue
+            owner = next((field for field in reversed(rest) if field), None)
+            if owner is None or first.version != last.version or last < first:
+                skipped += 1
+                continue
+            ranges[first.version].append((int(first), int(last), owner))
+    if skipped:
+        logger.info('Skipped %d rows of %s without a network and owner', skipped, path)
+    return ranges
+
+
+def flatten(ranges):
+    """Sorted, non-overlapping (first, last, owner) ranges, the narrowest network wins where they nest."""
+    flat = []
+
+    def emit(first, last, owner):
+        if first > last:
+            return
+        if flat and flat[-1][1] + 1 == first and flat[-1][2] == owner:
+            flat[-1] = (flat[-1][0], last, owner)
+        else:
+            flat.append((first, last, owner))
+
+    # Enclosing networks, each one narrower than the one below it
+    stack = []
+    position = 0
+    for first, last, owner in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        while stack and stack[-1][1] < first:
+            _, enclosing_last, enclosing_owner = stack.pop()
+            emit(position, enclosing_last, enclosing_owner)
+            position = max(position, enclosing_last + 1)
+        if stack:
+            emit(position, first - 1, stack[-1][2])
+        stack.append((first, last, owner))
+        position = max(position, first)
+    while stack:
+        _, enclosing_last, enclosing_owner = stack.pop()
+        emit(position, enclosing_last, enclosing_owner)
+        position = max(position, enclosing_last + 1)
+    return flat
+
+
+def build_index(source=IP_OWNER_FILE, path=IP_OWNER_INDEX):
+    """Compile `source` into the index file at `path`.
+
+    IPv4 ranges are stored as arrays of 32-bit integers, IPv6 ranges as
+    16-byte big-endian addresses, which sort like the integers. Owner names
+    are stored once, ranges refer to them by number.
+    """
+    stat = os.stat(source)
+    ranges = read_ranges(source)
+    owners = {}
+    sections = []
+    counts = {}
+    for version in (4, 6):
+        flat = flatten(ranges[version])
+        counts[version] = len(flat)
+        numbers = array.array('I', (owners.setdefault(owner, len(owners)) for _, _, owner in flat))
+        if version == 4:
+            sections += [array.array('I', (first for first, _, _ in flat)).tobytes(),
+                         array.array('I', (last for _, last, _ in flat)).tobytes()]
+        else:
+            sections += [b''.join(first.to_bytes(16, 'big') for first, _, _ in flat),
+                         b''.join(last.to_bytes(16, 'big') for _, last, _ in flat)]
+        sections.append(numbers.tobytes())
+    names = [owner.encode('utf-8') for owner in owners]
+    offsets = array.array('I', [0])
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    blob = b''.join(names)
+    # Every process builds to its own file, the last rename wins
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, BYTE_ORDER_MARK, stat.st_size, stat.st_mtime_ns, counts[4], counts[6], len(names), len(blob)))
+        for section in sections:
+            f.write(section)
+        f.write(offsets.tobytes())
+        f.write(blob)
+    os.replace(tmp_path, path)
+    logger.info('Built %s from %s: %d IPv4 and %d IPv6 ranges, %d owners', path, source, counts[4], counts[6], len(names))
+
+
+class AddressKeys:
+    """Sequence of the fixed-width big-endian addresses in a buffer, for bisect."""
+
+    def __init__(self, view, width):
+        self.view = view
+        self.width = width
+
+    def __len__(self):
+        return len(self.view) // self.width
+
+    def __getitem__(self, i):
+        return self.view[i * self.width:(i + 1) * self.width].tobytes()
+
+
+class OwnerIndex:
+    """Read-only view of an index file built by build_index, the pages are shared by every process mapping it."""
+
+    def __init__(self, path=IP_OWNER_INDEX):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, mark, self.source_size, self.source_mtime, count4, count6, owners, blob_size = HEADER.unpack_from(self.map)
+        if magic != MAGIC or mark != BYTE_ORDER_MARK:
+            self.map.close()
+            raise ValueError(f'{path} is not an owner index of this machine')
+        view = memoryview(self.map)
+        position = HEADER.size
+
+        def take(size):
+            nonlocal position
+            section = view[position:position + size]
+            position += size
+            return section
+
+        self.ranges = {
+            4: (take(4 * count4).cast('I'), take(4 * count4).cast('I'), take(4 * count4).cast('I')),
+            6: (AddressKeys(take(16 * count6), 16), AddressKeys(take(16 * count6), 16), take(4 * count6).cast('I')),
+        }
+        self.offsets = take(4 * (owners + 1)).cast('I')
+        self.names = take(blob_size)
+
+    def __len__(self):
+        return len(self.ranges[4][0]) + len(self.ranges[6][0])
+
+    def matches(self, source):
+        stat = os.stat(source)
+        return (stat.st_size, stat.st_mtime_ns) == (self.source_size, self.source_mtime)
+
+    def lookup(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        firsts, lasts, owners = self.ranges[address.version]
+        key = int(address) if address.version == 4 else address.packed
+        i = bisect.bisect_right(firsts, key) - 1
+        if i < 0 or lasts[i] < key:
+            return None
+        number = owners[i]
+        return self.names[self.offsets[number]:self.offsets[number + 1]].tobytes().decode('utf-8')
+
+
+def open_index(source=IP_OWNER_FILE, path=IP_OWNER_INDEX):
+    """The index of `source`, rebuilt first when it is missing or was built from another version of the file."""
+    try:
+        index = OwnerIndex(path)
+        if index.matches(source):
+            return index
+    except (OSError, ValueError, struct.error):
+        pass
+    build_index(source, path)
+    return OwnerIndex(path)
+
+
+owner_index = None
+owner_index_lock = threading.Lock()
+owner_index_failed = False
+
+
+def get_owner_index():
+    # Opened on the first lookup, None without IP_OWNER_FILE or when it cannot be read
+    global owner_index, owner_index_failed
+    if not IP_OWNER_FILE or owner_index_failed:
+        return None
+    with owner_index_lock:
+        if owner_index is None and not owner_index_failed:
+            try:
+                owner_index = open_index()
+            except (OSError, ValueError) as e:
+                logger.warning('Owner lookups use RDAP only, cannot open %s: %s', IP_OWNER_FILE, e)
+                owner_index_failed = True
+        return owner_index
+
+
+def lookup_owner(ip):
+    """Owner of `ip` from IP_OWNER_FILE, None when it is not listed or there is no file."""
+    index = get_owner_index()
+    if index is None:
+        return None
+    owner = index.lookup(ip)
+    if owner is not None:
+        rdap_lookups_total.inc(result='offline')
+    return owner
+
+
+if __name__ == '__main__':
+    # python ip_owners.py [ip ...] builds the index if needed and looks up the given addresses
+    configure_logging()
+    if not IP_OWNER_FILE:
+        sys.exit('Set IP_OWNER_FILE to the CSV or TSV file of networks and owners')
+    index = open_index()
+    print(f'{IP_OWNER_INDEX}: {len(index)} ranges')
+    for ip in sys.argv[1:]:
+        print(ip, index.lookup(ip))
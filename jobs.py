@@ -0,0 +1,124 @@
+import os, time, uuid, queue, logging, threading
+from metrics import jobs_total
+
+# Seconds between scheduled imports, 0 only imports when asked to
+INGEST_INTERVAL = int(os.getenv('INGEST_INTERVAL', 0))
+# Finished jobs kept for the status endpoint
+JOB_HISTORY = 50
+
+COUNTERS = ['messages', 'attachments', 'reports', 'duplicates', 'rejected', 'rdap_lookups']
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """One run of a background task with its state and progress counters."""
+
+    def __init__(self, name, task):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.task = task
+        self.state = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.counters = {counter: 0 for counter in COUNTERS}
+        self.lock = threading.Lock()
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def active(self):
+        return self.state in ('queued', 'running')
+
+    def to_dict(self):
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'counters': counters
+        }
+
+
+class JobQueue:
+    """Runs jobs one after another on a single worker thread.
+
+    A job is a function taking the Job, it reports progress through
+    job.count. Submitting a job while one with the same name is still
+    queued or running returns that job instead of queueing another.
+    """
+
+    def __init__(self, history=JOB_HISTORY):
+        self.history = history
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def submit(self, name, task):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.name == name and job.active():
+                    return job
+            job = Job(name, task)
+            self.jobs[job.id] = job
+            self.prune()
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.work, name='job-worker', daemon=True)
+                self.worker.start()
+        self.queue.put(job)
+        return job
+
+    def prune(self):
+        # Oldest finished jobs go first, dicts keep the submission order
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active()]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def recent(self, limit=None):
+        with self.lock:
+            jobs = list(self.jobs.values())[::-1]
+        return jobs[:limit] if limit else jobs
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.state = 'running'
+            job.started = time.time()
+            logger.info('Job %s %s started', job.name, job.id)
+            try:
+                job.task(job)
+                job.state = 'done'
+            except Exception as e:
+                logger.exception('Job %s %s failed', job.name, job.id)
+                job.error = str(e)
+                job.state = 'failed'
+            job.finished = time.time()
+            jobs_total.inc(name=job.name, state=job.state)
+            logger.info('Job %s %s %s: %s', job.name, job.id, job.state, job.counters)
+            self.queue.task_done()
+
+    def schedule(self, name, task, interval=INGEST_INTERVAL):
+        # Submits the task every `interval` seconds from a daemon thread, the first run starts right away
+        def submit_periodically():
+            while True:
+                self.submit(name, task)
+                time.sleep(interval)
+        thread = threading.Thread(target=submit_periodically, name=f'{name}-schedule', daemon=True)
+        thread.start()
+        return thread
+
+
+job_queue = JobQueue()
@@ -0,0 +1,30 @@
+"""Line logs shared by processes: appended in one write, read from an offset, rewritten atomically."""
+import os
+
+
+def read_lines(path, offset=0):
+    # Complete lines past `offset` and the offset after them, a partial last line is still being written
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    complete = data.rfind(b'\n') + 1
+    return data[:complete].decode('utf-8', 'replace').splitlines(), offset + complete
+
+
+def append_lines(path, lines):
+    # One write at the end of the file, other processes append to the same log
+    data = ''.join(line + '\n' for line in lines).encode('utf-8')
+    with open(path, 'ab+') as f:
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                # Terminate a line left behind by an interrupted write, so it does not run into these
+                data = b'\n' + data
+        f.write(data)
+
+
+def write_lines(path, lines):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.writelines(line + '\n' for line in lines)
+    os.replace(tmp_path, path)
@@ -0,0 +1,59 @@
+import os
+
+# Mailbox the dmarc CLI imports from, imap or graph
+MAIL_SOURCE = os.getenv('MAIL_SOURCE', 'imap')
+# App-only access for the CLI, the analyzer uses the account that signed in
+GRAPH_SCOPE = ['https://graph.microsoft.com/.default']
+
+
+class ImapSource:
+    """Report mails of the IMAP mailbox configured by EMAIL_HOST, EMAIL_ADDRESS and EMAIL_PASSWORD."""
+
+    name = 'imap'
+
+    def download(self, job=None, sink=None):
+        # imaplib and dotenv are only loaded for a download
+        from extract_attachments import extract_attachments
+        return extract_attachments(job, sink=sink)
+
+
+class GraphSource:
+    """Report mails of a Microsoft 365 mailbox, read through the Graph API at `endpoint`.
+
+    `token` is an access token or a function returning one. Without it the
+    app credentials (CLIENT_ID, CLIENT_SECRET, AUTHORITY) are used, which
+    needs the Mail.Read application permission and an ENDPOINT naming the
+    mailbox, e.g. https://graph.microsoft.com/v1.0/users/dmarc@example.com/messages.
+    """
+
+    name = 'graph'
+
+    def __init__(self, token=None, endpoint=None):
+        self.token = token or app_token
+        self.endpoint = endpoint or os.getenv('ENDPOINT')
+
+    def download(self, job=None, sink=None):
+        import graph_attachments
+        token = self.token() if callable(self.token) else self.token
+        if not token:
+            raise RuntimeError('Not signed in, log in once before importing')
+        return graph_attachments.download_attachments(token, self.endpoint, job, sink=sink)
+
+
+def app_token():
+    from msal import ConfidentialClientApplication
+    app = ConfidentialClientApplication(os.getenv('CLIENT_ID'), authority=os.getenv('AUTHORITY'),
+                                        client_credential=os.getenv('CLIENT_SECRET'))
+    result = app.acquire_token_for_client(scopes=GRAPH_SCOPE)
+    if 'access_token' not in result:
+        raise RuntimeError(f"Cannot get a Graph token: {result.get('error_description') or result.get('error')}")
+    return result['access_token']
+
+
+SOURCES = {'imap': ImapSource, 'graph': GraphSource}
+
+
+def mail_source(name=MAIL_SOURCE, **kwargs):
+    if name not in SOURCES:
+        raise ValueError(f'Unknown mail source {name!r}, expected one of {", ".join(SOURCES)}')
+    return SOURCES[name](**kwargs)
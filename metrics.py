@@ -0,0 +1,224 @@
+import os, time, bisect, logging, threading
+from contextlib import contextmanager
+from functools import wraps
+
+# DEBUG shows every fetched attachment and RDAP request, WARNING only problems
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+def configure_logging(level=LOG_LEVEL):
+    # Only the first call has an effect, and none when the server already set up logging
+    logging.basicConfig(level=level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A metric family in the Prometheus text format, one value per combination of label values."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        if not self.labels:
+            # Reported as zero before the first sample
+            self.values[()] = self.initial()
+        registry.append(self)
+
+    def initial(self):
+        return 0
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} takes the labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield self.name, list(zip(self.labels, key)), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, pairs, value in self.samples():
+            lines.append(f'{name}{format_labels(pairs)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or a function read when the metrics are collected."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, [], self.function()
+            return
+        else:
+            yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labels)
+
+    def initial(self):
+        # Per bucket counts, the +Inf bucket last, then the sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = self.initial()
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def timer(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        for key, counts in sorted(values.items()):
+            pairs = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', pairs + [('le', format_value(float(bound)))], cumulative
+            yield f'{self.name}_sum', pairs, counts[-1]
+            yield f'{self.name}_count', pairs, cumulative
+
+
+def render_metrics():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+stage_seconds = Histogram('dmarc_stage_duration_seconds', 'Time spent in each stage of the import and report pipeline', ['stage'])
+query_seconds = Histogram('dmarc_query_duration_seconds', 'Time spent in report store queries', ['operation'])
+request_seconds = Histogram('dmarc_http_request_duration_seconds', 'Time to answer an HTTP request, streamed pages until the last byte', ['endpoint'])
+requests_total = Counter('dmarc_http_requests_total', 'HTTP requests answered', ['endpoint', 'status'])
+messages_total = Counter('dmarc_messages_fetched_total', 'Report mails fetched from the mailbox', ['source'])
+attachments_total = Counter('dmarc_attachments_fetched_total', 'Attachments downloaded from the mailbox', ['source'])
+decompressed_bytes_total = Counter('dmarc_decompressed_bytes_total', 'Bytes of report XML decompressed from attachments')
+rejections_total = Counter('dmarc_attachments_rejected_total', 'Attachments quarantined by the decompression limits', ['reason'])
+duplicates_total = Counter('dmarc_duplicates_skipped_total', 'Attachments and reports skipped because their content was imported before', ['kind'])
+parse_errors_total = Counter('dmarc_parse_errors_total', 'Reports that failed to parse')
+reports_total = Counter('dmarc_reports_imported_total', 'New reports stored')
+records_total = Counter('dmarc_records_imported_total', 'Records of the new reports stored')
+rdap_lookups_total = Counter('dmarc_rdap_lookups_total', 'Owner lookups by result: offline owner file, cache hit, cache miss or failed request', ['result'])
+rdap_request_seconds = Histogram('dmarc_rdap_request_duration_seconds', 'Time of RDAP requests, including retries')
+jobs_total = Counter('dmarc_jobs_total', 'Background jobs finished', ['name', 'state'])
+reports_stored = Gauge('dmarc_reports_stored', 'Reports in the report store')
+rdap_cache_entries = Gauge('dmarc_rdap_cache_entries', 'Networks in the RDAP owner cache')
+content_index_digests = Gauge('dmarc_content_index_digests', 'Digests of imported attachments and reports')
+
+
+def timed_stage(stage):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage_seconds.timer(stage=stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_query(function):
+    # Store methods are timed under their own name
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with query_seconds.timer(operation=function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def instrument_app(app):
+    """Time the requests and template renders of a Flask app."""
+    from flask import g, request, before_render_template, template_rendered
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.get('request_started', time.perf_counter())
+        endpoint = request.endpoint or 'unknown'
+        status = response.status_code
+
+        def observe():
+            request_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+            requests_total.inc(endpoint=endpoint, status=status)
+        # Streamed pages are only complete once the body has been sent
+        response.call_on_close(observe)
+        return response
+
+    def template_started(sender, template, context, **extra):
+        g.setdefault('templates_started', {})[template.name] = time.perf_counter()
+
+    def template_finished(sender, template, context, **extra):
+        started = g.get('templates_started', {}).pop(template.name, None)
+        if started is not None:
+            stage_seconds.observe(time.perf_counter() - started, stage='template')
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_finished, app, weak=False)
@@ -0,0 +1,210 @@
+import os, io, sys, json, time, uuid, pstats, cProfile, logging, threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+# Off unless asked for: with PROFILING=true a request with ?profile=1 is profiled
+PROFILING = os.getenv('PROFILING', 'false').lower() == 'true'
+PROFILE_FOLDER = os.getenv('PROFILE_FOLDER', './profiles')
+# The oldest profiles are removed past this number
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', 20))
+# Seconds between two stack samples of the flame graph
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.005))
+
+# pstats for snakeviz or python -m pstats, collapsed stacks for flamegraph.pl or speedscope, a text summary
+FORMATS = ['prof', 'collapsed', 'txt']
+
+logger = logging.getLogger(__name__)
+
+# One profile at a time, the profiler hooks of the interpreter cannot be shared
+profile_lock = threading.Lock()
+
+
+class StackSampler:
+    """Counts the call stacks of one thread, sampled at a fixed interval."""
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+
+class Profile:
+    """cProfile statistics and sampled stacks of the calling thread, saved to PROFILE_FOLDER when stopped."""
+
+    def __init__(self, label):
+        self.label = label
+        now = time.time()
+        # Milliseconds too, the names sort in the order the profiles were taken
+        self.name = f'{time.strftime("%Y%m%d-%H%M%S", time.localtime(now))}{int(now * 1000) % 1000:03d}-{safe_label(label)}-{uuid.uuid4().hex[:6]}'
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident())
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        self.sampler.start()
+        self.profiler.enable()
+
+    def stop(self):
+        try:
+            self.profiler.disable()
+            self.sampler.stop()
+            save_profile(self, time.time() - self.started)
+        finally:
+            profile_lock.release()
+
+
+def safe_label(label):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in label or 'unknown')
+
+
+def start_profile(label, wait=False):
+    """Start profiling the calling thread, None when another profile is running and `wait` is false."""
+    if not profile_lock.acquire(blocking=wait):
+        logger.info('Not profiling %s, another profile is running', label)
+        return None
+    try:
+        profile = Profile(label)
+        profile.start()
+    except Exception:
+        profile_lock.release()
+        raise
+    return profile
+
+
+@contextmanager
+def profiled(label, wait=True):
+    profile = start_profile(label, wait)
+    try:
+        yield profile
+    finally:
+        if profile is not None:
+            profile.stop()
+
+
+def profiled_task(task, label):
+    # A background job profiled in its worker thread
+    @wraps(task)
+    def wrapper(*args, **kwargs):
+        with profiled(label):
+            return task(*args, **kwargs)
+    return wrapper
+
+
+def write_file(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def save_profile(profile, duration):
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    base = os.path.join(PROFILE_FOLDER, profile.name)
+    profile.profiler.dump_stats(base + '.prof.tmp')
+    os.replace(base + '.prof.tmp', base + '.prof')
+    write_file(base + '.collapsed', profile.sampler.collapsed())
+    # Written last, a profile is only listed once it is complete
+    write_file(base + '.json', json.dumps({'name': profile.name, 'label': profile.label,
+                                           'started': profile.started, 'duration': duration}))
+    logger.info('Profile of %s saved as %s (%.3f s)', profile.label, profile.name, duration)
+    rotate_profiles()
+
+
+def profile_names():
+    # Oldest first, the names start with their timestamp
+    if not os.path.isdir(PROFILE_FOLDER):
+        return []
+    return sorted(name[:-len('.json')] for name in os.listdir(PROFILE_FOLDER) if name.endswith('.json'))
+
+
+def rotate_profiles(max_files=PROFILE_MAX_FILES):
+    names = profile_names()
+    for name in names[:max(0, len(names) - max_files)]:
+        for extension in ['json', 'prof', 'collapsed']:
+            path = os.path.join(PROFILE_FOLDER, f'{name}.{extension}')
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def recent_profiles():
+    profiles = []
+    for name in reversed(profile_names()):
+        try:
+            with open(os.path.join(PROFILE_FOLDER, name + '.json'), 'r') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            # Removed by a rotation in between
+            continue
+    return profiles
+
+
+def profile_path(name, extension='prof'):
+    """Path of a saved profile, None for unknown names."""
+    if name not in profile_names():
+        return None
+    return os.path.abspath(os.path.join(PROFILE_FOLDER, f'{name}.{extension}'))
+
+
+def profile_text(name, limit=50):
+    # The functions with the highest cumulative time, as python -m pstats prints them
+    stream = io.StringIO()
+    pstats.Stats(profile_path(name), stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+
+def profile_requested(request):
+    return PROFILING and request.args.get('profile', '').lower() in ('1', 'true')
+
+
+def profile_app(app, endpoints):
+    """Profile requests to `endpoints` that ask for it with ?profile=1, when PROFILING is on.
+
+    The profile runs until the response is closed, so streamed pages are
+    covered up to the last byte. Its name is sent in the X-Profile header.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_request_profile():
+        if request.endpoint in endpoints and profile_requested(request):
+            g.profile = start_profile(request.endpoint, wait=False)
+
+    @app.after_request
+    def name_request_profile(response):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            response.headers['X-Profile'] = profile.name
+            response.call_on_close(profile.stop)
+        return response
+
+    @app.teardown_request
+    def stop_failed_request_profile(error=None):
+        # after_request is skipped when the view raised
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.stop()
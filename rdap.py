@@ -0,0 +1,342 @@
+import os, json, math, time, bisect, logging, ipaddress, threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from metrics import timed_stage, rdap_lookups_total, rdap_request_seconds, rdap_cache_entries
+from ip_owners import lookup_owner, flatten
+
+RDAP_URL = os.getenv('RDAP_URL', 'https://www.rdap.net/ip/')
+RDAP_CACHE_FILE = os.getenv('RDAP_CACHE_FILE', 'rdap_cache.json')
+RDAP_CACHE_TTL = int(os.getenv('RDAP_CACHE_TTL', 30 * 24 * 3600))
+RDAP_NEGATIVE_TTL = int(os.getenv('RDAP_NEGATIVE_TTL', 3600))
+RDAP_CACHE_MAX_ENTRIES = int(os.getenv('RDAP_CACHE_MAX_ENTRIES', 50000))
+RDAP_WORKERS = int(os.getenv('RDAP_WORKERS', 8))
+RDAP_RATE_LIMIT = float(os.getenv('RDAP_RATE_LIMIT', 10))
+RDAP_RETRIES = int(os.getenv('RDAP_RETRIES', 2))
+RDAP_TIMEOUT = (3.05, float(os.getenv('RDAP_TIMEOUT', 10)))
+
+logger = logging.getLogger(__name__)
+
+
+class RDAPCache:
+    """On-disk owner cache keyed by the network range RDAP returns for an IP."""
+
+    def __init__(self, path=RDAP_CACHE_FILE, ttl=RDAP_CACHE_TTL, negative_ttl=RDAP_NEGATIVE_TTL, max_entries=RDAP_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Per IP version: sorted start addresses and matching (start, end, owner, expires) entries
+        self.starts = {4: [], 6: []}
+        self.entries = {4: [], 6: []}
+        # Per IP version: the entries that have not expired as non-overlapping ranges, the narrowest network wins,
+        # (starts, (start, end, (owner, expires)) ranges, time the first of them expires). Rebuilt after a change
+        self.flat = {4: None, 6: None}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = False
+        self.load()
+
+    def __len__(self):
+        return len(self.entries[4]) + len(self.entries[6])
+
+    def lookup(self, ip, count=True):
+        # `count` is off when the same address was looked up and counted before
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        value = int(address)
+        now = time.time()
+        with self.lock:
+            starts, ranges, _ = self.flat_ranges(address.version, now)
+            i = bisect.bisect_right(starts, value) - 1
+            owner = ranges[i][2][0] if i >= 0 and ranges[i][1] >= value else None
+            if not count:
+                return owner
+            if owner is None:
+                self.misses += 1
+                rdap_lookups_total.inc(result='miss')
+                return None
+            self.hits += 1
+            rdap_lookups_total.inc(result='hit')
+            return owner
+
+    def flat_ranges(self, version, now):
+        # Called with the lock held, one bisect then answers a lookup however the cached networks nest
+        flat = self.flat[version]
+        if flat is None or flat[2] <= now:
+            live = [entry for entry in self.entries[version] if entry[3] > now]
+            ranges = flatten([(start, end, (owner, expires)) for start, end, owner, expires in live])
+            flat = self.flat[version] = ([start for start, _, _ in ranges], ranges, min((entry[3] for entry in live), default=math.inf))
+        return flat
+
+    def store(self, start, end, owner, ttl=None):
+        start = ipaddress.ip_address(start)
+        end = ipaddress.ip_address(end)
+        if start.version != end.version or int(end) < int(start):
+            raise ValueError(f'Invalid network range {start} - {end}')
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        entry = (int(start), int(end), owner, expires)
+        with self.lock:
+            starts = self.starts[start.version]
+            entries = self.entries[start.version]
+            i = bisect.bisect_left(starts, entry[0])
+            # Replace an entry for the exact same range instead of stacking duplicates
+            while i < len(starts) and starts[i] == entry[0]:
+                if entries[i][1] == entry[1]:
+                    del starts[i]
+                    del entries[i]
+                    break
+                i += 1
+            i = bisect.bisect_right(starts, entry[0])
+            starts.insert(i, entry[0])
+            entries.insert(i, entry)
+            self.flat[start.version] = None
+            self.dirty = True
+            if len(self.entries[4]) + len(self.entries[6]) > self.max_entries:
+                self._evict(now=time.time())
+
+    def store_response(self, ip, data):
+        owner = data.get('name', 'Unknown')
+        address = ipaddress.ip_address(ip)
+        for start, end in network_ranges(data):
+            if start.version == address.version and start <= address <= end:
+                self.store(start, end, owner)
+                break
+        else:
+            # No usable range in the response, cache just this address
+            self.store(address, address, owner)
+        return owner
+
+    def store_failure(self, ip):
+        address = ipaddress.ip_address(ip)
+        self.store(address, address, 'Unknown', ttl=self.negative_ttl)
+
+    def _evict(self, now):
+        for version in (4, 6):
+            kept = [entry for entry in self.entries[version] if entry[3] > now]
+            self.evictions += len(self.entries[version]) - len(kept)
+            self.entries[version] = kept
+        if len(self) > self.max_entries:
+            # Drop the entries closest to expiry first, leaving some headroom
+            overflow = len(self) - int(self.max_entries * 0.9)
+            oldest = sorted((entry[3], version, entry[0], entry[1]) for version in (4, 6) for entry in self.entries[version])[:overflow]
+            dropped = set((version, start, end) for _, version, start, end in oldest)
+            for version in (4, 6):
+                self.entries[version] = [entry for entry in self.entries[version] if (version, entry[0], entry[1]) not in dropped]
+            self.evictions += overflow
+        for version in (4, 6):
+            self.starts[version] = [entry[0] for entry in self.entries[version]]
+            self.flat[version] = None
+
+    def evict(self):
+        with self.lock:
+            self._evict(now=time.time())
+            self.dirty = True
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable RDAP cache %s: %s', self.path, e)
+            return
+        now = time.time()
+        with self.lock:
+            for version, start, end, owner, expires in data.get('entries', []):
+                if expires > now:
+                    self.entries[version].append((start, end, owner, expires))
+            for version in (4, 6):
+                self.entries[version].sort()
+                self.starts[version] = [entry[0] for entry in self.entries[version]]
+                self.flat[version] = None
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            self._evict(now=time.time())
+            entries = [[version, *entry] for version in (4, 6) for entry in self.entries[version]]
+            self.dirty = False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'evictions': self.evictions
+        }
+
+
+def network_ranges(data):
+    # RDAP IP network objects carry startAddress/endAddress and optionally cidr0_cidrs
+    ranges = []
+    try:
+        if data.get('startAddress') and data.get('endAddress'):
+            ranges.append((ipaddress.ip_address(data['startAddress']), ipaddress.ip_address(data['endAddress'])))
+        for cidr in data.get('cidr0_cidrs', []):
+            prefix = cidr.get('v4prefix') or cidr.get('v6prefix')
+            if prefix and cidr.get('length') is not None:
+                network = ipaddress.ip_network(f"{prefix}/{cidr['length']}", strict=False)
+                ranges.append((network.network_address, network.broadcast_address))
+    except (ValueError, TypeError, AttributeError):
+        pass
+    # Prefer the narrowest range that was announced
+    ranges.sort(key=lambda r: int(r[1]) - int(r[0]))
+    return ranges
+
+
+class RateLimiter:
+    """Spaces out requests so that at most `rate` start per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+rdap_cache = RDAPCache()
+rdap_cache_entries.set_function(lambda: len(rdap_cache))
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def create_session(pool_size=RDAP_WORKERS, retries=RDAP_RETRIES):
+    # requests is only imported once an owner is not in the cache, imports of known senders and queries never load it
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',), respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.headers['Accept'] = 'application/rdap+json'
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            session = create_session()
+        return session
+
+
+def rate_limiter(url):
+    host = urlsplit(url).netloc
+    with rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = RateLimiter(RDAP_RATE_LIMIT)
+        return rate_limiters[host]
+
+
+def query_rdap(ip):
+    url = f'{RDAP_URL}{ip}'
+    try:
+        logger.debug('Fetching RDAP data for IP %s', ip)
+        rate_limiter(url).wait()
+        with rdap_request_seconds.timer():
+            response = get_session().get(url, timeout=RDAP_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        return rdap_cache.store_response(ip, data)
+    # requests.RequestException is an OSError
+    except (OSError, ValueError) as e:
+        logger.warning('Error fetching RDAP data for IP %s: %s', ip, e)
+        rdap_lookups_total.inc(result='error')
+        try:
+            rdap_cache.store_failure(ip)
+        except ValueError:
+            pass
+        return 'Unknown'
+
+
+def block_key(ip):
+    # Addresses in the same /24 (IPv4) or /48 (IPv6) usually share one RDAP network
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    prefix = 24 if address.version == 4 else 48
+    return ipaddress.ip_network(f'{address}/{prefix}', strict=False)
+
+
+@timed_stage('rdap')
+def enrich_reports(reports, workers=RDAP_WORKERS, job=None):
+    # Resolve the owner of every distinct source IP in the batch once, concurrently, `job` counts the lookups
+    ips = set()
+    for report in reports:
+        for record in report['records']:
+            if record.get('owner') is None:
+                ips.add(record['source_ip'])
+    if not ips:
+        return reports
+    owners = {}
+    pending = []
+    for ip in sorted(ips, key=str):
+        # The offline owner file first, RDAP only for the addresses it does not list
+        owner = lookup_owner(ip) or rdap_cache.lookup(ip)
+        if owner is None:
+            pending.append(ip)
+        else:
+            owners[ip] = owner
+    if pending:
+        # Query one address per block first, the cached network then answers most of the rest
+        leaders = {}
+        rest = []
+        for ip in pending:
+            if leaders.setdefault(block_key(ip), ip) != ip:
+                rest.append(ip)
+        leaders = list(leaders.values())
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for ip, owner in zip(leaders, executor.map(query_rdap, leaders)):
+                owners[ip] = owner
+            remaining = []
+            for ip in rest:
+                # Counted as a miss above already
+                owner = rdap_cache.lookup(ip, count=False)
+                if owner is None:
+                    remaining.append(ip)
+                else:
+                    owners[ip] = owner
+            for ip, owner in zip(remaining, executor.map(query_rdap, remaining)):
+                owners[ip] = owner
+        if job:
+            job.count('rdap_lookups', len(leaders) + len(remaining))
+    for report in reports:
+        for record in report['records']:
+            if record.get('owner') is None:
+                record['owner'] = owners.get(record['source_ip'], 'Unknown')
+    if rdap_cache.dirty:
+        rdap_cache.save()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('RDAP cache: %s', rdap_cache.stats())
+    return reports
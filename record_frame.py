@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+# Frame column behind each sort column of the failure tables
+SORT_FIELDS = {'date': 'begin', 'count': 'count', 'source_ip': 'source_ip', 'auth_results_spf_result': 'auth_results_spf_result',
+               'auth_results_dkim_result': 'auth_results_dkim_result', 'policy_evaluated_spf': 'policy_evaluated_spf', 'policy_evaluated_dkim': 'policy_evaluated_dkim'}
+# Repetitive string columns are stored as categoricals
+CATEGORY_COLUMNS = ['domain', 'source_ip', 'auth_results_spf_result', 'auth_results_dkim_result', 'policy_evaluated_spf', 'policy_evaluated_dkim',
+                    'owner', 'header_from', 'envelope_from', 'auth_results_dkim_domain', 'auth_results_spf_domain']
+
+
+def build_frame(reports, first_report=0):
+    """Flatten the records of `reports` into one row per record.
+
+    `report` and `record` hold the position of the record in the report
+    list (counted from `first_report`) and in its report, so the original
+    dicts can be returned for the rows a mask selects.
+    """
+    columns = {name: [] for name in ['report', 'record', 'domain', 'begin', 'end', 'count'] + CATEGORY_COLUMNS[1:]}
+    for position, report in enumerate(reports, first_report):
+        records = report['records']
+        size = len(records)
+        columns['report'].extend([position] * size)
+        columns['record'].extend(range(size))
+        columns['domain'].extend([report['domain']] * size)
+        columns['begin'].extend([report['date_range']['begin']] * size)
+        columns['end'].extend([report['date_range']['end']] * size)
+        for record in records:
+            columns['count'].append(record['count'])
+            for name in CATEGORY_COLUMNS[1:]:
+                columns[name].append(record.get(name))
+    frame = pd.DataFrame(columns)
+    frame['report'] = frame['report'].astype(np.int64)
+    frame['record'] = frame['record'].astype(np.int64)
+    frame['count'] = frame['count'].astype(np.int64)
+    frame['begin'] = pd.to_datetime(frame['begin'], format='%Y-%m-%d')
+    frame['end'] = pd.to_datetime(frame['end'], format='%Y-%m-%d')
+    for name in CATEGORY_COLUMNS:
+        frame[name] = frame[name].astype('category')
+    return frame
+
+
+def extend_frame(frame, reports, first_report):
+    if not reports:
+        return frame
+    frame = pd.concat([frame, build_frame(reports, first_report)], ignore_index=True)
+    # concat falls back to object columns when the categories differ
+    for name in CATEGORY_COLUMNS:
+        if not isinstance(frame[name].dtype, pd.CategoricalDtype):
+            frame[name] = frame[name].astype('category')
+    return frame
+
+
+def filter_mask(frame, domain=None, start_date=None, end_date=None):
+    mask = np.ones(len(frame), dtype=bool)
+    if domain:
+        mask &= (frame['domain'] == domain).to_numpy()
+    if start_date:
+        mask &= (frame['begin'] >= pd.Timestamp(start_date)).to_numpy()
+    if end_date:
+        mask &= (frame['end'] <= pd.Timestamp(end_date)).to_numpy()
+    return mask
+
+
+def failed_mask(frame, column):
+    # Missing results count as failed, like any other value that is not 'pass'
+    return (frame[column] != 'pass').to_numpy()
+
+
+def sort_key(frame, sort):
+    values = frame[SORT_FIELDS[sort]]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Categories are kept sorted, so the codes sort like the strings, missing values are -1
+        codes = values.cat.codes.to_numpy().astype(np.int64)
+        return codes, codes < 0
+    return values.to_numpy().astype(np.int64), np.zeros(len(frame), dtype=bool)
+
+
+def page_entries(frame, mask, reports, sort=None, descending=False, offset=0, limit=None):
+    """(record, date_range) pairs of the rows `mask` selects, sorted on `sort` and sliced to one page.
+
+    Ties keep the store order and missing values sort last either way.
+    """
+    rows = np.flatnonzero(mask)
+    if sort:
+        key, missing = sort_key(frame, sort)
+        key, missing = key[rows], missing[rows]
+        rows = rows[np.lexsort((rows, -key if descending else key, missing))]
+    rows = rows[offset:offset + limit if limit is not None else None]
+    positions = frame[['report', 'record']].to_numpy()[rows]
+    return [(reports[report]['records'][record], reports[report]['date_range']) for report, record in positions.tolist()]
+
+
+def group_entries(frame, mask, keys, sort, descending=False, offset=0, limit=None):
+    """Roll the rows `mask` selects up by `keys`, returns (total, page).
+
+    Ties are broken by messages, most first, and then by the keys, missing
+    values sort last. SQLiteReportStore.failed_groups orders the same way.
+    """
+    selected = frame.loc[mask, keys + ['count', 'begin', 'end']]
+    groups = selected.groupby(keys, observed=True, dropna=False, sort=False).agg(
+        messages=('count', 'sum'), records=('count', 'size'), first_seen=('begin', 'min'), last_seen=('end', 'max')).reset_index()
+    order = [sort] + [name for name in ['messages'] + keys if name != sort]
+    ascending = [not descending] + [name != 'messages' for name in order[1:]]
+    groups = groups.sort_values(order, ascending=ascending, na_position='last', kind='stable')
+    page = groups.iloc[offset:offset + limit if limit is not None else None]
+    entries = []
+    for group in page.to_dict('records'):
+        for name in keys:
+            if pd.isna(group[name]):
+                group[name] = None
+        group['messages'] = int(group['messages'])
+        group['records'] = int(group['records'])
+        group['first_seen'] = group['first_seen'].strftime('%Y-%m-%d')
+        group['last_seen'] = group['last_seen'].strftime('%Y-%m-%d')
+        entries.append(group)
+    return len(groups), entries
+
+
+def result_counts(frame, mask, columns, weighted=False):
+    counts = {}
+    selected = frame.loc[mask]
+    for column in columns:
+        if weighted:
+            values = selected.groupby(column, observed=True)['count'].sum()
+        else:
+            values = selected[column].value_counts(sort=False)
+        counts[column] = {value: int(count) for value, count in values.items() if count}
+    return counts
+
+
+def failure_summary(frame, mask, columns):
+    summary = {}
+    for column in columns:
+        selected = frame.loc[mask & failed_mask(frame, column)]
+        summary[column] = {
+            'records': int(len(selected)),
+            'messages': int(selected['count'].sum()),
+            'source_ips': int(selected['source_ip'].nunique())
+        }
+    return summary
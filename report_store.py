@@ -0,0 +1,416 @@
+import os, json, uuid, hashlib, logging, threading
+from datetime import datetime, timedelta
+from rollups import DailyRollups, ROLLUPS_FILE
+from logfile import read_lines, append_lines, write_lines
+from metrics import timed_query, duplicates_total, reports_stored
+
+REPORTS_FILE = 'imported_reports.json'
+INDEX_FILE = 'report_index.log'
+CONTENT_INDEX_FILE = os.getenv('CONTENT_INDEX_FILE', 'content_index.log')
+REPORT_BACKEND = os.getenv('REPORT_BACKEND', 'json')
+
+logger = logging.getLogger(__name__)
+
+# Record columns a report is checked against, a record fails a column unless it is 'pass'
+RESULT_COLUMNS = ['auth_results_spf_result', 'auth_results_dkim_result', 'policy_evaluated_spf', 'policy_evaluated_dkim']
+# Failure tables of the report page: query string prefix, result column and title
+FAILURE_TABLES = [
+    ('spf', 'auth_results_spf_result', 'Failed SPF Entries'),
+    ('dkim', 'auth_results_dkim_result', 'Failed DKIM Entries'),
+    ('spf_policy', 'policy_evaluated_spf', 'Failed SPF Policy Entries'),
+    ('dkim_policy', 'policy_evaluated_dkim', 'Failed DKIM Policy Entries')
+]
+# Columns the failure tables can be sorted on, 'date' is the begin of the report's date range
+SORT_COLUMNS = ['date', 'count', 'source_ip'] + RESULT_COLUMNS
+# Sender identifiers failed records are grouped by, and the totals kept per group
+GROUP_COLUMNS = ['source_ip', 'owner', 'header_from', 'envelope_from', 'auth_results_dkim_domain', 'auth_results_dkim_result', 'auth_results_spf_domain', 'auth_results_spf_result']
+GROUP_TOTALS = ['messages', 'records', 'first_seen', 'last_seen']
+
+
+def report_key(report):
+    # Receivers keep report_id unique per organization, the date range covers reports without one
+    if report.get('report_id'):
+        return f"{report.get('organization')}|{report['report_id']}"
+    return f"{report.get('organization')}|{report.get('domain')}|{report['date_range']['begin']}|{report['date_range']['end']}"
+
+
+def group_columns(column):
+    # The failed result column is part of the key, for the policy tables it is not one of the identifiers
+    return GROUP_COLUMNS + ([column] if column not in GROUP_COLUMNS else [])
+
+
+class ReportIndex:
+    """Persistent set of report keys used to drop duplicates in constant time.
+
+    The file holds one key per line. A save appends the keys added since
+    the last one, it is only rewritten when it drifted from the store.
+    """
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self.keys = set()
+        # Keys in the file, and the ones still to be appended to it
+        self.stored = 0
+        self.pending = []
+        self.rewrite = False
+        if path and os.path.exists(path):
+            try:
+                lines, _ = read_lines(path)
+                self.keys = set(line for line in lines if line)
+                self.stored = len(lines)
+            except OSError as e:
+                logger.warning('Rebuilding unreadable report index %s: %s', path, e)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, report, save=True):
+        # Reports another process appended are in the file already, `save` is off for them
+        key = report_key(report)
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        if save:
+            self.pending.append(key)
+        return True
+
+    def sync(self, reports):
+        # The index belongs to the report store, rewrite it if they drifted apart
+        if self.stored == len(reports) and not self.pending:
+            return
+        keys = set(report_key(report) for report in reports)
+        if keys != self.keys or len(keys) != self.stored + len(self.pending):
+            self.keys = keys
+            self.pending = []
+            self.rewrite = True
+
+    def save(self):
+        if not self.path:
+            self.pending = []
+            return
+        if self.rewrite:
+            write_lines(self.path, sorted(self.keys))
+            self.stored = len(self.keys)
+            self.rewrite = False
+        elif self.pending:
+            append_lines(self.path, self.pending)
+            self.stored += len(self.pending)
+        self.pending = []
+
+
+class ContentIndex:
+    """Persistent set of SHA-256 digests of attachments and report XML that were imported before.
+
+    Copies of known content are dropped before they are decompressed or
+    parsed. `skipped` counts them and their size, the work that was avoided.
+    The file is a log shared by every process: one digest per line, and a
+    'skip <kind> <size> <writer>' line per dropped copy. A save appends the
+    lines added since the last one, `refresh` reads what others appended.
+    """
+
+    def __init__(self, path=CONTENT_INDEX_FILE):
+        self.path = path
+        self.digests = set()
+        self.skipped = {'attachments': 0, 'reports': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+        # Marks this instance's skip lines, which are counted already when they are read back
+        self.writer = uuid.uuid4().hex[:8]
+        self.pending = []
+        self.offset = 0
+        if path and not os.path.exists(path):
+            self.convert(os.path.splitext(path)[0] + '.json')
+        self.refresh()
+
+    def convert(self, legacy_path):
+        # The JSON file of earlier versions, written out as a log once
+        if not os.path.exists(legacy_path):
+            return
+        try:
+            with open(legacy_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable content index %s: %s', legacy_path, e)
+            return
+        skipped = data.get('skipped', {})
+        lines = sorted(data.get('digests', []))
+        lines.append(f"skip attachments {skipped.get('attachments', 0)} {skipped.get('bytes', 0)} legacy")
+        lines.append(f"skip reports {skipped.get('reports', 0)} 0 legacy")
+        write_lines(self.path, lines)
+        logger.info('Converted %s to %s', legacy_path, self.path)
+
+    def refresh(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with self.lock:
+            try:
+                lines, self.offset = read_lines(self.path, self.offset)
+            except OSError as e:
+                logger.warning('Cannot read content index %s: %s', self.path, e)
+                return
+            for line in lines:
+                if not line.startswith('skip '):
+                    if line:
+                        self.digests.add(line)
+                    continue
+                fields = line.split()
+                if (len(fields) == 5 and fields[1] in ('attachments', 'reports') and fields[2].isdigit() and fields[3].isdigit()
+                        and fields[4] != self.writer):
+                    self.skipped[fields[1]] += int(fields[2])
+                    self.skipped['bytes'] += int(fields[3])
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def __contains__(self, digest):
+        return digest in self.digests
+
+    def __len__(self):
+        return len(self.digests)
+
+    def add(self, digests):
+        with self.lock:
+            for digest in digests:
+                if digest not in self.digests:
+                    self.digests.add(digest)
+                    self.pending.append(digest)
+
+    def skip(self, kind, size):
+        with self.lock:
+            self.skipped[kind] += 1
+            self.skipped['bytes'] += size
+            self.pending.append(f'skip {kind} 1 {size} {self.writer}')
+        duplicates_total.inc(kind=kind)
+
+    def save(self):
+        with self.lock:
+            if self.pending and self.path:
+                append_lines(self.path, self.pending)
+            self.pending = []
+
+
+class ReportStore:
+    """Append-only JSON lines archive with an in-memory copy.
+
+    The file is read once and afterwards only the bytes appended since the
+    last read are parsed. Existing lines are never rewritten. `version`
+    changes whenever the reports change, so anything derived from them can
+    be cached against it.
+    """
+
+    def __init__(self, path=REPORTS_FILE, index_path=INDEX_FILE, rollups_path=ROLLUPS_FILE):
+        self.path = path
+        self.index = ReportIndex(index_path)
+        self.rollups = DailyRollups(RESULT_COLUMNS, rollups_path)
+        self.lock = threading.RLock()
+        self.reports = []
+        self.version = 0
+        self.offset = 0
+        self.loaded = False
+        # Columnar copy of the records, see record_frame
+        self.frame = None
+        self.frame_reports = 0
+        self.generation = 0
+        self.frame_generation = 0
+
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                self.loaded = True
+                self.refresh()
+                self.index.sync(self.reports)
+                self.index.save()
+                self.rollups.sync(self.reports)
+                self.rollups.save()
+            return self.reports
+
+    def refresh(self):
+        with self.lock:
+            if not self.loaded:
+                return self.load()
+            if not os.path.exists(self.path):
+                return self.reports
+            size = os.path.getsize(self.path)
+            if size < self.offset:
+                # The file was replaced by something shorter, start over
+                self.reports = []
+                self.offset = 0
+                self.version += 1
+                self.generation += 1
+                # The keys of the old contents would drop their re-imports as duplicates
+                self.index.sync([])
+                self.rollups.sync([])
+            if size == self.offset:
+                return self.reports
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            # Only complete lines are consumed, a partial last line is still being written or was cut off by a crash
+            complete = data.rfind(b'\n') + 1
+            new_reports = []
+            for line in data[:complete].splitlines():
+                if line.strip():
+                    try:
+                        new_reports.append(json.loads(line))
+                    except ValueError:
+                        logger.warning('Skipping damaged line in %s', self.path)
+            self.offset += complete
+            if new_reports:
+                self.reports = self.reports + new_reports
+                for report in new_reports:
+                    # Their keys are in the index file already, appended by whoever wrote them
+                    self.index.add(report, save=False)
+                self.version += 1
+            return self.reports
+
+    def append(self, reports):
+        if not reports:
+            return
+        with self.lock:
+            self.refresh()
+            # Reports appended by other processes, they saved their own counts
+            self.rollups.sync(self.reports, save=False)
+            lines = ''.join(json.dumps(report) + '\n' for report in reports).encode('utf-8')
+            with open(self.path, 'ab') as f:
+                if f.tell() > self.offset:
+                    # Terminate a line left behind by an interrupted write, it is skipped when reading
+                    lines = b'\n' + lines
+                # One write followed by fsync, a reader never sees part of this batch as complete lines
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+                self.offset = f.tell()
+            # A new list, so callers iterating the previous version are not affected
+            self.reports = self.reports + list(reports)
+            for report in reports:
+                self.index.add(report)
+            self.index.save()
+            self.rollups.sync(self.reports)
+            self.rollups.save()
+            self.version += 1
+
+    def __len__(self):
+        return len(self.load())
+
+    @timed_query
+    def domains(self):
+        return sorted(set(report['domain'] for report in self.load()))
+
+    @timed_query
+    def count_reports(self, domain=None, start_date=None, end_date=None):
+        return len(self.filter_reports(domain, start_date, end_date))
+
+    def filter_reports(self, domain=None, start_date=None, end_date=None):
+        # Dates are 'YYYY-MM-DD' strings, which compare in calendar order
+        return [report for report in self.load()
+                if (not domain or report['domain'] == domain)
+                and (not start_date or report['date_range']['begin'] >= start_date)
+                and (not end_date or report['date_range']['end'] <= end_date)]
+
+    def record_frame(self):
+        # Built on first use and extended with the reports appended since
+        import record_frame
+        with self.lock:
+            reports = self.load()
+            if self.frame is None or self.frame_generation != self.generation:
+                self.frame = record_frame.build_frame(reports)
+                self.frame_generation = self.generation
+            elif self.frame_reports < len(reports):
+                self.frame = record_frame.extend_frame(self.frame, reports[self.frame_reports:], self.frame_reports)
+            self.frame_reports = len(reports)
+            return self.frame, reports
+
+    @timed_query
+    def result_counts(self, columns=RESULT_COLUMNS, domain=None, start_date=None, end_date=None, weighted=False):
+        # Records per result, or with `weighted` the messages they stand for
+        import record_frame
+        frame, _ = self.record_frame()
+        return record_frame.result_counts(frame, record_frame.filter_mask(frame, domain, start_date, end_date), columns, weighted)
+
+    @timed_query
+    def failure_summary(self, columns=RESULT_COLUMNS, domain=None, start_date=None, end_date=None):
+        import record_frame
+        frame, _ = self.record_frame()
+        return record_frame.failure_summary(frame, record_frame.filter_mask(frame, domain, start_date, end_date), columns)
+
+    @timed_query
+    def failed_page(self, column, domain=None, start_date=None, end_date=None, sort=None, descending=False, offset=0, limit=None):
+        # One page of the records failing `column` as (record, date_range) pairs, in store order unless sorted
+        import record_frame
+        if column not in RESULT_COLUMNS:
+            raise ValueError(f'Unknown result column {column}')
+        if sort and sort not in SORT_COLUMNS:
+            raise ValueError(f'Unknown sort column {sort}')
+        frame, reports = self.record_frame()
+        mask = record_frame.filter_mask(frame, domain, start_date, end_date) & record_frame.failed_mask(frame, column)
+        return record_frame.page_entries(frame, mask, reports, sort, descending, offset, limit)
+
+    @timed_query
+    def failed_groups(self, column, domain=None, start_date=None, end_date=None, sort=None, descending=False, offset=0, limit=None):
+        """Records failing `column` rolled up by group_columns(column), returns (total, page).
+
+        Groups carry their key, the summed messages, the number of records
+        and the first and last day they were seen. Without `sort` the groups
+        with the most messages come first.
+        """
+        import record_frame
+        if column not in RESULT_COLUMNS:
+            raise ValueError(f'Unknown result column {column}')
+        keys = group_columns(column)
+        if sort and sort not in keys + GROUP_TOTALS:
+            raise ValueError(f'Unknown sort column {sort}')
+        frame, _ = self.record_frame()
+        mask = record_frame.filter_mask(frame, domain, start_date, end_date) & record_frame.failed_mask(frame, column)
+        return record_frame.group_entries(frame, mask, keys, sort or 'messages', descending if sort else True, offset, limit)
+
+    @timed_query
+    def daily_rollups(self, after, before, domain=None):
+        with self.lock:
+            self.rollups.sync(self.load(), save=False)
+        return self.rollups.buckets(after, before, domain)
+
+    @timed_query
+    def failed_domains(self, after, before):
+        # Domains with at least one failing record in the days strictly between the two dates
+        with self.lock:
+            self.rollups.sync(self.load(), save=False)
+        return self.rollups.failed_domains(after, before)
+
+
+def aggregate_summary(store, domain=None, start_date=None, end_date=None):
+    # Records and messages per result for dashboards, the pie charts are drawn from the messages
+    return {
+        'domain': domain,
+        'start_date': start_date,
+        'end_date': end_date,
+        'counts': store.result_counts(RESULT_COLUMNS, domain, start_date, end_date),
+        'messages': store.result_counts(RESULT_COLUMNS, domain, start_date, end_date, weighted=True),
+        'failures': store.failure_summary(RESULT_COLUMNS, domain, start_date, end_date)
+    }
+
+
+def recent_rollups(store, days=7, domain=None):
+    # Per-domain daily pass/fail counts for the last days, cheap enough for monitoring to poll
+    now = datetime.now()
+    after = (now - timedelta(days=days)).strftime('%Y-%m-%d')
+    before = now.strftime('%Y-%m-%d')
+    return {
+        'after': after,
+        'before': before,
+        'failed_domains': store.failed_domains(after, before),
+        'rollups': store.daily_rollups(after, before, domain)
+    }
+
+
+def open_store(backend=REPORT_BACKEND):
+    if backend == 'sqlite':
+        from sqlite_store import SQLiteReportStore
+        return SQLiteReportStore()
+    return ReportStore()
+
+
+store = open_store()
+reports_stored.set_function(lambda: len(store))
@@ -0,0 +1,129 @@
+import os
+from flask import request, url_for
+from report_store import SORT_COLUMNS, GROUP_TOTALS, FAILURE_TABLES, group_columns
+
+# Rows per page of the failure tables, `limit` in the query string overrides it up to TABLE_MAX_PAGE_SIZE
+TABLE_PAGE_SIZE = int(os.getenv('TABLE_PAGE_SIZE', 100))
+TABLE_MAX_PAGE_SIZE = int(os.getenv('TABLE_MAX_PAGE_SIZE', 1000))
+
+TABLE_HEADERS = ['source_ip', 'owner', 'date', 'count', 'policy_evaluated_disposition', 'policy_evaluated_dkim', 'policy_evaluated_spf', 'envelope_to', 'header_from', 'envelope_from', 'auth_results_dkim_domain', 'auth_results_dkim_result', 'auth_results_spf_domain', 'auth_results_spf_result']
+
+# Result values with a cell style in report.html
+CELL_CLASSES = {'fail', 'none', 'neutral', 'softfail', 'temperror', 'permerror'}
+
+
+def cell_class(value):
+    value = str(value).lower()
+    return value if value in CELL_CLASSES else ''
+
+
+def table_args():
+    limit = request.args.get('limit', TABLE_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), TABLE_MAX_PAGE_SIZE)
+    return limit, request.args.get('sort'), request.args.get('order') == 'desc'
+
+
+def grouped_view():
+    # The tables roll the records up by sender unless view=records asks for the raw rows
+    return request.args.get('view') != 'records'
+
+
+def first_pages():
+    return {f'{name}_offset': None for name, _, _ in FAILURE_TABLES}
+
+
+def table_view():
+    # Link that switches between groups and records, sorting and paging start over
+    grouped = grouped_view()
+    return {'grouped': grouped, 'switch': page_url(view=None if not grouped else 'records', sort=None, order=None, **first_pages())}
+
+
+def page_url(**changes):
+    # The current page with some query arguments replaced, None drops an argument
+    args = request.args.to_dict()
+    args.update(changes)
+    return url_for(request.endpoint, **{name: value for name, value in args.items() if value is not None})
+
+
+def group_rows(groups, headers):
+    return [[(group[header], cell_class(group[header])) for header in headers] for group in groups]
+
+
+def table_rows(entries, headers):
+    # Entries are (record, date_range) pairs, each cell is a (value, css class) pair
+    rows = []
+    for record, date_range in entries:
+        row = []
+        for header in headers:
+            value = date_range['begin'] + " - " + date_range['end'] if header == 'date' else record.get(header, '')
+            row.append((value, cell_class(value)))
+        rows.append(row)
+    return rows
+
+
+def table_headers(headers, sortable, sort, descending):
+    # Sorting starts over at the first page of every table
+    columns = []
+    for header in headers:
+        url = None
+        if header in sortable:
+            order = 'desc' if header == sort and not descending else 'asc'
+            url = page_url(sort=header, order=order, **first_pages())
+        columns.append({'name': header, 'url': url, 'sorted': ('desc' if descending else 'asc') if header == sort else None})
+    return columns
+
+
+def table_offset(name):
+    return max(request.args.get(f'{name}_offset', 0, type=int), 0)
+
+
+def last_page(total, limit):
+    return (total - 1) // limit * limit
+
+
+def failure_tables(store, summary, domain=None, start_date=None, end_date=None):
+    """Yield one page of every failure table that has rows.
+
+    By default a table lists groups of records from the same sender, see
+    the stores' failed_groups, with view=records it lists the records.
+    `summary` is the store's failure_summary, its record counts are the
+    totals of the record tables. The pages are only queried while the
+    template is being streamed, so the top of the report goes out before
+    the tables.
+    """
+    limit, sort, descending = table_args()
+    for name, column, title in FAILURE_TABLES:
+        if not summary[column]['records']:
+            continue
+        if grouped_view():
+            headers = group_columns(column) + GROUP_TOTALS
+            table_sort = sort if sort in headers else None
+            offset = table_offset(name)
+            total, groups = store.failed_groups(column, domain, start_date, end_date, table_sort, descending, offset, limit)
+            if offset >= total:
+                # Past the last page, show the last one instead
+                offset = last_page(total, limit)
+                total, groups = store.failed_groups(column, domain, start_date, end_date, table_sort, descending, offset, limit)
+            rows = group_rows(groups, headers)
+            # Without a sort the groups with the most messages come first
+            columns = table_headers(headers, headers, table_sort or 'messages', descending if table_sort else True)
+            unit = 'groups'
+        else:
+            table_sort = sort if sort in SORT_COLUMNS else None
+            total = summary[column]['records']
+            offset = min(table_offset(name), last_page(total, limit))
+            entries = store.failed_page(column, domain, start_date, end_date, table_sort, descending, offset, limit)
+            rows = table_rows(entries, TABLE_HEADERS)
+            columns = table_headers(TABLE_HEADERS, SORT_COLUMNS, table_sort, descending)
+            unit = 'records'
+        yield {
+            'title': title,
+            'headers': columns,
+            'rows': rows,
+            'total': total,
+            'unit': unit,
+            'first': offset + 1,
+            'last': offset + len(rows),
+            'previous': page_url(**{f'{name}_offset': max(offset - limit, 0) or None}) if offset else None,
+            'next': page_url(**{f'{name}_offset': offset + limit}) if offset + limit < total else None
+        }
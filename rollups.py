@@ -0,0 +1,125 @@
+import os, json, logging
+from datetime import datetime, timedelta
+from logfile import read_lines, append_lines, write_lines
+
+ROLLUPS_FILE = 'daily_rollups.log'
+
+logger = logging.getLogger(__name__)
+
+
+def empty_bucket(domain, day, columns):
+    return {
+        'domain': domain,
+        'day': day,
+        'reports': 0,
+        'records': 0,
+        'messages': 0,
+        'results': {column: {'pass': 0, 'fail': 0} for column in columns}
+    }
+
+
+def count_report(days, report, columns):
+    day = report['date_range']['begin']
+    domains = days.setdefault(day, {})
+    if report['domain'] not in domains:
+        domains[report['domain']] = empty_bucket(report['domain'], day, columns)
+    bucket = domains[report['domain']]
+    bucket['reports'] += 1
+    for record in report['records']:
+        bucket['records'] += 1
+        bucket['messages'] += record['count']
+        for column in columns:
+            bucket['results'][column]['pass' if record[column] == 'pass' else 'fail'] += 1
+
+
+def merge_days(days, other):
+    # Adds the buckets of `other` to `days`
+    for day, domains in other.items():
+        for domain, counts in domains.items():
+            bucket = days.setdefault(day, {}).setdefault(domain, empty_bucket(domain, day, counts['results']))
+            for name in ('reports', 'records', 'messages'):
+                bucket[name] += counts[name]
+            for column, results in counts['results'].items():
+                totals = bucket['results'].setdefault(column, {'pass': 0, 'fail': 0})
+                totals['pass'] += results['pass']
+                totals['fail'] += results['fail']
+
+
+def bucket_failed(bucket):
+    return any(counts['fail'] for counts in bucket['results'].values())
+
+
+class DailyRollups:
+    """Pass/fail record counts per (domain, day), kept up to date as reports arrive.
+
+    A report is counted on the day its date range begins. The buckets are
+    stored per day so a query only touches the days it asks for. The file
+    is a log of JSON lines, each with the counts of the reports added since
+    the previous one, and is only rewritten when the store started over.
+    """
+
+    def __init__(self, columns, path=ROLLUPS_FILE):
+        self.columns = columns
+        self.path = path
+        self.days = {}
+        self.report_count = 0
+        # Counts of the reports added since the last save
+        self.pending = {}
+        self.pending_count = 0
+        self.rewrite = False
+        if path and os.path.exists(path):
+            try:
+                # A line cut off by a crash is left out, sync counts its reports again
+                for line in read_lines(path)[0]:
+                    if line:
+                        data = json.loads(line)
+                        merge_days(self.days, data.get('days', {}))
+                        self.report_count += data.get('reports', 0)
+            except (OSError, ValueError) as e:
+                logger.warning('Rebuilding unreadable rollups %s: %s', path, e)
+                self.days = {}
+                self.report_count = 0
+                self.rewrite = True
+
+    def add(self, report, save=True):
+        # Reports another process appended are in the file already, `save` is off for them
+        count_report(self.days, report, self.columns)
+        self.report_count += 1
+        if save:
+            count_report(self.pending, report, self.columns)
+            self.pending_count += 1
+
+    def sync(self, reports, save=True):
+        # The store is append-only, so only the reports past the ones already counted are added
+        if self.report_count > len(reports):
+            self.days = {}
+            self.report_count = 0
+            self.pending = {}
+            self.pending_count = 0
+            self.rewrite = True
+        for report in reports[self.report_count:]:
+            self.add(report, save)
+
+    def buckets(self, after, before, domain=None):
+        # Buckets of the days strictly between `after` and `before` ('YYYY-MM-DD')
+        buckets = []
+        day = datetime.strptime(after, '%Y-%m-%d') + timedelta(days=1)
+        last = datetime.strptime(before, '%Y-%m-%d')
+        while day < last:
+            for bucket_domain, bucket in sorted(self.days.get(day.strftime('%Y-%m-%d'), {}).items()):
+                if not domain or bucket_domain == domain:
+                    buckets.append(bucket)
+            day += timedelta(days=1)
+        return buckets
+
+    def failed_domains(self, after, before):
+        return sorted(set(bucket['domain'] for bucket in self.buckets(after, before) if bucket_failed(bucket)))
+
+    def save(self):
+        if self.path and self.rewrite:
+            write_lines(self.path, [json.dumps({'reports': self.report_count, 'days': self.days})])
+            self.rewrite = False
+        elif self.path and self.pending_count:
+            append_lines(self.path, [json.dumps({'reports': self.pending_count, 'days': self.pending})])
+        self.pending = {}
+        self.pending_count = 0
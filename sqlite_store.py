@@ -0,0 +1,344 @@
+import os, sqlite3, logging, argparse, threading
+from report_store import ReportStore, report_key, group_columns, RESULT_COLUMNS, SORT_COLUMNS, GROUP_TOTALS, REPORTS_FILE
+from rollups import empty_bucket
+from metrics import configure_logging, timed_query
+
+REPORTS_DB = os.getenv('REPORTS_DB', 'reports.db')
+
+logger = logging.getLogger(__name__)
+
+REPORT_COLUMNS = ['organization', 'domain', 'report_id', 'adkim', 'aspf', 'p', 'sp', 'pct', 'fo']
+RECORD_COLUMNS = ['source_ip', 'owner', 'count', 'policy_evaluated_disposition', 'policy_evaluated_dkim', 'policy_evaluated_spf',
+                  'envelope_to', 'header_from', 'envelope_from', 'auth_results_dkim_domain', 'auth_results_dkim_result',
+                  'auth_results_spf_domain', 'auth_results_spf_result']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    report_key TEXT NOT NULL UNIQUE,
+    organization TEXT,
+    domain TEXT,
+    report_id TEXT,
+    date_begin TEXT NOT NULL,
+    date_end TEXT NOT NULL,
+    adkim TEXT,
+    aspf TEXT,
+    p TEXT,
+    sp TEXT,
+    pct INTEGER,
+    fo TEXT
+);
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    report INTEGER NOT NULL REFERENCES reports(id),
+    source_ip TEXT,
+    owner TEXT,
+    count INTEGER,
+    policy_evaluated_disposition TEXT,
+    policy_evaluated_dkim TEXT,
+    policy_evaluated_spf TEXT,
+    envelope_to TEXT,
+    header_from TEXT,
+    envelope_from TEXT,
+    auth_results_dkim_domain TEXT,
+    auth_results_dkim_result TEXT,
+    auth_results_spf_domain TEXT,
+    auth_results_spf_result TEXT
+);
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    domain TEXT NOT NULL,
+    day TEXT NOT NULL,
+    reports INTEGER NOT NULL DEFAULT 0,
+    records INTEGER NOT NULL DEFAULT 0,
+    messages INTEGER NOT NULL DEFAULT 0,
+{rollup_columns}
+    PRIMARY KEY (day, domain)
+);
+CREATE INDEX IF NOT EXISTS reports_domain_dates ON reports (domain, date_begin, date_end);
+CREATE INDEX IF NOT EXISTS reports_dates ON reports (date_begin, date_end);
+CREATE INDEX IF NOT EXISTS records_report ON records (report);
+CREATE INDEX IF NOT EXISTS records_source_ip ON records (source_ip);
+"""
+SCHEMA = SCHEMA.replace('{rollup_columns}', ''.join(f'    {column}_pass INTEGER NOT NULL DEFAULT 0,\n    {column}_fail INTEGER NOT NULL DEFAULT 0,\n'
+                                                      for column in RESULT_COLUMNS))
+# Partial indexes only hold the failing rows, which are the ones the failure tables ask for
+SCHEMA += ''.join(f"CREATE INDEX IF NOT EXISTS records_failed_{column} ON records (report) WHERE {column} IS NOT 'pass';\n"
+                  for column in RESULT_COLUMNS)
+
+
+class SQLiteReportStore:
+    """Report store backed by SQLite, filters run as indexed queries."""
+
+    def __init__(self, path=REPORTS_DB):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        with self.connect() as connection:
+            connection.executescript(SCHEMA)
+            if connection.execute('SELECT 1 FROM reports').fetchone() and not connection.execute('SELECT 1 FROM daily_rollups').fetchone():
+                # Databases created before the rollups existed
+                self.rebuild_rollups(connection)
+        self.index = ReportKeys(self)
+
+    def connect(self):
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    def load(self):
+        # Nothing to read up front, every query goes to the database. Only the reports property builds them all
+        return None
+
+    def refresh(self):
+        return None
+
+    @property
+    def reports(self):
+        return self.filter_reports()
+
+    @property
+    def version(self):
+        # Reports are only ever added, so the highest id identifies the contents
+        return self.connect().execute('SELECT COALESCE(MAX(id), 0) FROM reports').fetchone()[0]
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM reports').fetchone()[0]
+
+    def append(self, reports):
+        if not reports:
+            return 0
+        added = 0
+        with self.lock, self.connect() as connection:
+            for report in reports:
+                cursor = connection.execute(
+                    'INSERT OR IGNORE INTO reports (report_key, date_begin, date_end, ' + ', '.join(REPORT_COLUMNS) + ') '
+                    'VALUES (?, ?, ?, ' + ', '.join('?' for _ in REPORT_COLUMNS) + ')',
+                    [report_key(report), report['date_range']['begin'], report['date_range']['end']] + [report.get(column) for column in REPORT_COLUMNS])
+                if not cursor.rowcount:
+                    continue
+                added += 1
+                connection.executemany(
+                    'INSERT INTO records (report, ' + ', '.join(RECORD_COLUMNS) + ') VALUES (?, ' + ', '.join('?' for _ in RECORD_COLUMNS) + ')',
+                    [[cursor.lastrowid] + [record.get(column) for column in RECORD_COLUMNS] for record in report['records']])
+                self.add_rollup(connection, report)
+        return added
+
+    def add_rollup(self, connection, report):
+        counts = [1, len(report['records']), sum(record['count'] for record in report['records'])]
+        for column in RESULT_COLUMNS:
+            passed = sum(1 for record in report['records'] if record[column] == 'pass')
+            counts += [passed, len(report['records']) - passed]
+        names = ['reports', 'records', 'messages'] + [f'{column}_{result}' for column in RESULT_COLUMNS for result in ('pass', 'fail')]
+        connection.execute(
+            'INSERT INTO daily_rollups (domain, day, ' + ', '.join(names) + ') VALUES (?, ?, ' + ', '.join('?' for _ in names) + ') '
+            'ON CONFLICT (day, domain) DO UPDATE SET ' + ', '.join(f'{name} = {name} + excluded.{name}' for name in names),
+            [report['domain'], report['date_range']['begin']] + counts)
+
+    def rebuild_rollups(self, connection):
+        # SUM is NULL for a report without records, the rollup columns are NOT NULL
+        results = ''.join(f", COALESCE(SUM(r.{column} = 'pass'), 0), COALESCE(SUM(r.id IS NOT NULL AND r.{column} IS NOT 'pass'), 0)"
+                          for column in RESULT_COLUMNS)
+        names = ''.join(f', {column}_pass, {column}_fail' for column in RESULT_COLUMNS)
+        connection.execute('DELETE FROM daily_rollups')
+        connection.execute(
+            'INSERT INTO daily_rollups (domain, day, reports, records, messages' + names + ') '
+            'SELECT p.domain, p.date_begin, COUNT(DISTINCT p.id), COUNT(r.id), COALESCE(SUM(r.count), 0)' + results + ' '
+            'FROM reports p LEFT JOIN records r ON r.report = p.id GROUP BY p.domain, p.date_begin')
+
+    @timed_query
+    def domains(self):
+        return [row[0] for row in self.connect().execute('SELECT DISTINCT domain FROM reports ORDER BY domain')]
+
+    def where(self, domain, start_date, end_date):
+        clauses = []
+        params = []
+        if domain:
+            clauses.append('p.domain = ?')
+            params.append(domain)
+        if start_date:
+            clauses.append('p.date_begin >= ?')
+            params.append(start_date)
+        if end_date:
+            clauses.append('p.date_end <= ?')
+            params.append(end_date)
+        return (' AND '.join(clauses) or '1'), params
+
+    def filter_reports(self, domain=None, start_date=None, end_date=None):
+        where, params = self.where(domain, start_date, end_date)
+        connection = self.connect()
+        reports = {}
+        for row in connection.execute('SELECT * FROM reports p WHERE ' + where + ' ORDER BY p.id', params):
+            reports[row['id']] = row_to_report(row)
+        if not reports:
+            return []
+        for row in connection.execute('SELECT r.* FROM records r JOIN reports p ON p.id = r.report WHERE ' + where + ' ORDER BY r.id', params):
+            reports[row['report']]['records'].append(row_to_record(row))
+        return list(reports.values())
+
+    @timed_query
+    def failed_page(self, column, domain=None, start_date=None, end_date=None, sort=None, descending=False, offset=0, limit=None):
+        if column not in RESULT_COLUMNS:
+            raise ValueError(f'Unknown result column {column}')
+        order = 'r.report, r.id'
+        if sort:
+            if sort not in SORT_COLUMNS:
+                raise ValueError(f'Unknown sort column {sort}')
+            field = 'p.date_begin' if sort == 'date' else 'r.' + sort
+            # Missing values last either way, ties in store order like the JSON store
+            order = f"{field} IS NULL, {field} {'DESC' if descending else 'ASC'}, " + order
+        where, params = self.where(domain, start_date, end_date)
+        params = params + [-1 if limit is None else limit, offset]
+        rows = self.connect().execute(
+            f"SELECT r.*, p.date_begin, p.date_end FROM records r JOIN reports p ON p.id = r.report WHERE r.{column} IS NOT 'pass' AND "
+            + where + ' ORDER BY ' + order + ' LIMIT ? OFFSET ?', params)
+        date_ranges = {}
+        entries = []
+        for row in rows:
+            date_range = date_ranges.get(row['report'])
+            if date_range is None:
+                date_range = date_ranges[row['report']] = {'begin': row['date_begin'], 'end': row['date_end']}
+            entries.append((row_to_record(row), date_range))
+        return entries
+
+    @timed_query
+    def failed_groups(self, column, domain=None, start_date=None, end_date=None, sort=None, descending=False, offset=0, limit=None):
+        # Same groups and order as ReportStore.failed_groups
+        if column not in RESULT_COLUMNS:
+            raise ValueError(f'Unknown result column {column}')
+        keys = group_columns(column)
+        if sort and sort not in keys + GROUP_TOTALS:
+            raise ValueError(f'Unknown sort column {sort}')
+        if not sort:
+            sort, descending = 'messages', True
+        where, params = self.where(domain, start_date, end_date)
+        grouped = (f"FROM records r JOIN reports p ON p.id = r.report WHERE r.{column} IS NOT 'pass' AND " + where
+                   + ' GROUP BY ' + ', '.join('r.' + key for key in keys))
+        connection = self.connect()
+        total = connection.execute('SELECT COUNT(*) FROM (SELECT 1 ' + grouped + ')', params).fetchone()[0]
+        order = []
+        for name in [sort] + [name for name in ['messages'] + keys if name != sort]:
+            direction = 'DESC' if (descending if name == sort else name == 'messages') else 'ASC'
+            order.append(f'{name} IS NULL, {name} {direction}')
+        rows = connection.execute(
+            'SELECT ' + ', '.join(f'r.{key} AS {key}' for key in keys)
+            + ', SUM(r.count) AS messages, COUNT(*) AS records, MIN(p.date_begin) AS first_seen, MAX(p.date_end) AS last_seen '
+            + grouped + ' ORDER BY ' + ', '.join(order) + ' LIMIT ? OFFSET ?', params + [-1 if limit is None else limit, offset])
+        return total, [dict(row) for row in rows]
+
+    @timed_query
+    def count_reports(self, domain=None, start_date=None, end_date=None):
+        where, params = self.where(domain, start_date, end_date)
+        return self.connect().execute('SELECT COUNT(*) FROM reports p WHERE ' + where, params).fetchone()[0]
+
+    @timed_query
+    def result_counts(self, columns=RESULT_COLUMNS, domain=None, start_date=None, end_date=None, weighted=False):
+        where, params = self.where(domain, start_date, end_date)
+        connection = self.connect()
+        counts = {}
+        total = 'SUM(r.count)' if weighted else 'COUNT(*)'
+        for column in columns:
+            if column not in RESULT_COLUMNS:
+                raise ValueError(f'Unknown result column {column}')
+            rows = connection.execute(
+                f'SELECT r.{column}, {total} FROM records r JOIN reports p ON p.id = r.report WHERE ' + where + f' GROUP BY r.{column}', params)
+            counts[column] = {row[0]: row[1] for row in rows if row[0] is not None}
+        return counts
+
+    @timed_query
+    def failure_summary(self, columns=RESULT_COLUMNS, domain=None, start_date=None, end_date=None):
+        where, params = self.where(domain, start_date, end_date)
+        connection = self.connect()
+        summary = {}
+        for column in columns:
+            if column not in RESULT_COLUMNS:
+                raise ValueError(f'Unknown result column {column}')
+            row = connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(r.count), 0), COUNT(DISTINCT r.source_ip) FROM records r JOIN reports p ON p.id = r.report '
+                f"WHERE r.{column} IS NOT 'pass' AND " + where, params).fetchone()
+            summary[column] = {'records': row[0], 'messages': row[1], 'source_ips': row[2]}
+        return summary
+
+    @timed_query
+    def daily_rollups(self, after, before, domain=None):
+        params = [after, before]
+        where = 'day > ? AND day < ?'
+        if domain:
+            where += ' AND domain = ?'
+            params.append(domain)
+        buckets = []
+        for row in self.connect().execute('SELECT * FROM daily_rollups WHERE ' + where + ' ORDER BY day, domain', params):
+            bucket = empty_bucket(row['domain'], row['day'], RESULT_COLUMNS)
+            bucket['reports'] = row['reports']
+            bucket['records'] = row['records']
+            bucket['messages'] = row['messages']
+            for column in RESULT_COLUMNS:
+                bucket['results'][column] = {'pass': row[f'{column}_pass'], 'fail': row[f'{column}_fail']}
+            buckets.append(bucket)
+        return buckets
+
+    @timed_query
+    def failed_domains(self, after, before):
+        # Domains with at least one failing record in the days strictly between the two dates
+        failing = ' OR '.join(f'{column}_fail > 0' for column in RESULT_COLUMNS)
+        rows = self.connect().execute(
+            'SELECT DISTINCT domain FROM daily_rollups WHERE day > ? AND day < ? AND (' + failing + ') ORDER BY domain', (after, before))
+        return [row[0] for row in rows]
+
+
+class ReportKeys:
+    # Membership test against the UNIQUE report_key column, mirrors ReportIndex
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, key):
+        return self.store.connect().execute('SELECT 1 FROM reports WHERE report_key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return len(self.store)
+
+
+def row_to_report(row):
+    return {
+        'organization': row['organization'],
+        'domain': row['domain'],
+        'report_id': row['report_id'],
+        'date_range': {'begin': row['date_begin'], 'end': row['date_end']},
+        'adkim': row['adkim'],
+        'aspf': row['aspf'],
+        'p': row['p'],
+        'sp': row['sp'],
+        'pct': row['pct'],
+        'fo': row['fo'],
+        'records': []
+    }
+
+
+def row_to_record(row):
+    return {column: row[column] for column in RECORD_COLUMNS}
+
+
+def migrate(json_path=REPORTS_FILE, db_path=REPORTS_DB):
+    # Read only: without index and rollup paths the archive's state files, or the live ones, are never written
+    reports = ReportStore(json_path, index_path=None, rollups_path=None).load()
+    store = SQLiteReportStore(db_path)
+    added = 0
+    for i in range(0, len(reports), 500):
+        added += store.append(reports[i:i + 500])
+    logger.info('Migrated %d of %d reports from %s to %s', added, len(reports), json_path, db_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import imported_reports.json into the SQLite report store')
+    parser.add_argument('--json', default=REPORTS_FILE, help='JSON lines archive to import')
+    parser.add_argument('--db', default=REPORTS_DB, help='SQLite database to import into')
+    args = parser.parse_args()
+    configure_logging()
+    migrate(args.json, args.db)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+import os, sys, tempfile
+
+# The modules live at the top of the checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Their default state files are relative paths, keep them out of the checkout
+os.chdir(tempfile.mkdtemp(prefix='dmarc-tests-'))
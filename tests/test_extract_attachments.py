@@ -0,0 +1,101 @@
+import pytest
+import extract_attachments
+from extract_attachments import fetch_items, attachment_parts, split_tokens, OPEN, CLOSE
+
+# Recorded from a UID FETCH (UID BODYSTRUCTURE) of three report mails, as imaplib returns it
+STRUCTURES = [
+    b'1 (UID 1 BODYSTRUCTURE ("application" "gzip" ("name" "report1.xml.gz") NIL NIL "base64" 48 NIL ("attachment" ("filename" "report1.xml.gz")) NIL NIL))',
+    b'2 (UID 2 BODYSTRUCTURE ((("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 2 1 NIL NIL NIL NIL)("text" "html" ("charset" "utf-8") NIL NIL '
+    b'"quoted-printable" 9 1 NIL NIL NIL NIL) "alternative" ("boundary" "b1") NIL NIL NIL)("application" "gzip" ("name" "=?utf-8?q?r=C3=A9port2.xml.gz?=") '
+    b'NIL NIL "base64" 48 NIL ("attachment" ("filename" "=?utf-8?q?r=C3=A9port2.xml.gz?=")) NIL NIL) "mixed" ("boundary" "b1") NIL NIL NIL))',
+    b'3 (UID 3 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 5 1 NIL NIL NIL NIL)("application" "zip" ("name" "report3.zip") NIL NIL '
+    b'"base64" 176 NIL ("attachment" ("filename" "report3.zip")) NIL NIL) "mixed" ("boundary" "b1") NIL NIL NIL))',
+]
+
+# The parts of two messages, each body arrives as a literal
+BODIES = [
+    (b'1 (UID 1 BODY[1] {48}', b'H4sIAGQR1WoC/7NJS01NSUpMzrYzstGHswFWB6ntFgAAAA=='),
+    b')',
+    (b'2 (UID 2 BODY[2] {12}', b'(not) "a" )'),
+    b')',
+]
+
+
+def test_single_part_message():
+    assert attachment_parts(fetch_items(STRUCTURES)[1][b'BODYSTRUCTURE']) == [('1', 'report1.xml.gz', b'base64')]
+
+
+def test_multipart_with_encoded_filename():
+    # The text parts are nested in an alternative part and have no file name
+    assert attachment_parts(fetch_items(STRUCTURES)[2][b'BODYSTRUCTURE']) == [('2', 'réport2.xml.gz', b'base64')]
+    assert attachment_parts(fetch_items(STRUCTURES)[3][b'BODYSTRUCTURE']) == [('2', 'report3.zip', b'base64')]
+
+
+def test_literal_bodies():
+    # Literals are taken as they are, whatever they contain
+    items = fetch_items(BODIES)
+    assert items[1][b'BODY[1]'] == b'H4sIAGQR1WoC/7NJS01NSUpMzrYzstGHswFWB6ntFgAAAA=='
+    assert items[2][b'BODY[2]'] == b'(not) "a" )'
+
+
+def test_literal_inside_the_body_structure():
+    # Servers send strings with quotes or line breaks as literals, also within a BODYSTRUCTURE
+    items = fetch_items([
+        (b'4 (UID 9 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 5 1 NIL NIL NIL NIL)("application" "zip" ("name" {19}',
+         b'report "quoted".zip'),
+        b') NIL NIL "base64" 100 NIL NIL NIL NIL) "mixed" ("boundary" "b1") NIL NIL NIL))',
+    ])
+    assert attachment_parts(items[9][b'BODYSTRUCTURE']) == [('2', 'report "quoted".zip', b'base64')]
+
+
+def test_quoted_strings_and_nil():
+    assert split_tokens(b'("a \\"b\\"" NIL x)') == [OPEN, b'a "b"', None, b'x', CLOSE]
+
+
+# A report forwarded as an attachment: the gzip sits inside the message/rfc822 part
+FORWARDED = [
+    b'1 (UID 7 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 20 1 NIL NIL NIL NIL)'
+    b'("message" "rfc822" NIL NIL NIL "7bit" 900 ("Mon, 5 Oct 2026 10:00:00 +0000" "Report domain: example.com" NIL NIL NIL NIL NIL NIL NIL "<1@example.com>")'
+    b' (("text" "plain" ("charset" "us-ascii") NIL NIL "7bit" 10 1 NIL NIL NIL NIL)'
+    b'("application" "gzip" ("name" "google.com!example.com!1!2.xml.gz") NIL NIL "base64" 400 NIL'
+    b' ("attachment" ("filename" "google.com!example.com!1!2.xml.gz")) NIL NIL) "mixed" ("boundary" "b2") NIL NIL NIL)'
+    b' 30 NIL NIL NIL NIL) "mixed" ("boundary" "b1") NIL NIL NIL))',
+]
+
+
+def test_attachment_inside_forwarded_message():
+    structure = fetch_items(FORWARDED)[7][b'BODYSTRUCTURE']
+    assert attachment_parts(structure) == [('2.2', 'google.com!example.com!1!2.xml.gz', b'base64')]
+
+
+def test_single_part_forwarded_message():
+    # The embedded message is the gzip itself, its body is section 1.1
+    structure = fetch_items([
+        b'2 (UID 8 BODYSTRUCTURE ("message" "rfc822" NIL NIL NIL "7bit" 600 (NIL NIL NIL NIL NIL NIL NIL NIL NIL NIL)'
+        b' ("application" "gzip" ("name" "report.xml.gz") NIL NIL "base64" 400 NIL NIL NIL NIL) 12 NIL NIL NIL NIL))',
+    ])[8][b'BODYSTRUCTURE']
+    assert attachment_parts(structure) == [('1.1', 'report.xml.gz', b'base64')]
+
+
+class FakeMail:
+    def logout(self):
+        pass
+
+
+class FakeSink:
+    def flush(self):
+        pass
+
+
+def test_uidvalidity_change_stops_the_download(tmp_path, monkeypatch):
+    uidvalidities = iter([7, 8, 8, 8, 8])
+    fetched = []
+    monkeypatch.setattr(extract_attachments, 'connect', lambda: (FakeMail(), next(uidvalidities)))
+    monkeypatch.setattr(extract_attachments, 'new_uids', lambda mail, last_uid: list(range(1, 21)))
+    monkeypatch.setattr(extract_attachments, 'fetch_batch', lambda mail, batch, sink, job=None: fetched.append(batch) or len(batch))
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    with pytest.raises(extract_attachments.UIDValidityChanged):
+        extract_attachments.extract_attachments(connections=2, batch_size=5, checkpoint_path=checkpoint_path, sink=FakeSink())
+    # No batch is fetched with UIDs of the old mailbox state, and the checkpoint stays where it was
+    assert fetched == []
+    assert extract_attachments.Checkpoint(checkpoint_path).mailboxes == {}
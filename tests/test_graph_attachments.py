@@ -0,0 +1,55 @@
+import graph_attachments
+from graph_attachments import SyncState, message_key
+
+
+class FakeSink:
+    def flush(self):
+        pass
+
+
+def report(message_id):
+    return {'id': message_id, 'subject': 'Report domain: example.com', 'hasAttachments': True}
+
+
+def run(monkeypatch, tmp_path, pages, folders=('inbox',)):
+    # pages: {delta url or link: page}, returns the messages whose attachments were fetched
+    fetched = []
+    monkeypatch.setattr(graph_attachments, 'get_json', lambda session, url, headers, params=None: pages[url])
+    monkeypatch.setattr(graph_attachments, 'save_attachments',
+                        lambda session, headers, endpoint, message, sink, job=None: fetched.append(message['id']) or 1)
+    graph_attachments.download_attachments('token', 'https://graph.example/v1.0/me/messages', workers=1,
+                                           delta_path=str(tmp_path / 'delta.json'), sink=FakeSink(), folders=list(folders))
+    return fetched
+
+
+def seen(tmp_path, folder='inbox'):
+    return SyncState(str(tmp_path / 'delta.json')).get(graph_attachments.delta_url('https://graph.example/v1.0/me/messages', folder))[1]
+
+
+def test_seen_messages_are_pruned(monkeypatch, tmp_path):
+    url = 'https://graph.example/v1.0/me/mailFolders/inbox/messages/delta'
+    assert run(monkeypatch, tmp_path, {url: {'value': [report('a'), report('b'), report('c')], '@odata.deltaLink': 'link1'}}) == ['a', 'b', 'c']
+    # b was read and comes back, c was deleted
+    fetched = run(monkeypatch, tmp_path, {'link1': {'value': [report('b'), {'id': 'c', '@removed': {'reason': 'deleted'}}],
+                                                    '@odata.deltaLink': 'link2'}})
+    assert fetched == []
+    assert seen(tmp_path) == {message_key('a'), message_key('b')}
+
+
+def test_full_sync_keeps_only_messages_in_the_folder(monkeypatch, tmp_path):
+    url = 'https://graph.example/v1.0/me/mailFolders/inbox/messages/delta'
+    run(monkeypatch, tmp_path, {url: {'value': [report('a'), report('b')], '@odata.deltaLink': 'link1'}})
+    # The sync state is lost and the folder is listed again, b was moved out in between
+    state = SyncState(str(tmp_path / 'delta.json'))
+    state.set(url, None, state.get(url)[1])
+    assert run(monkeypatch, tmp_path, {url: {'value': [report('a'), report('d')], '@odata.deltaLink': 'link2'}}) == ['d']
+    assert seen(tmp_path) == {message_key('a'), message_key('d')}
+
+
+def test_several_folders(monkeypatch, tmp_path):
+    base = 'https://graph.example/v1.0/me/mailFolders'
+    fetched = run(monkeypatch, tmp_path, {f'{base}/inbox/messages/delta': {'value': [report('a')], '@odata.deltaLink': 'inbox1'},
+                                          f'{base}/dmarc/messages/delta': {'value': [report('b')], '@odata.deltaLink': 'dmarc1'}},
+                  folders=('inbox', 'dmarc'))
+    assert fetched == ['a', 'b']
+    assert seen(tmp_path, 'dmarc') == {message_key('b')}
@@ -0,0 +1,29 @@
+import time
+from rdap import RDAPCache
+
+
+def test_wide_range_behind_many_narrow_ones():
+    cache = RDAPCache(path='')
+    cache.store('10.0.0.0', '10.255.255.255', 'wide')
+    for number in range(20):
+        cache.store(f'10.0.{number}.0', f'10.0.{number}.255', f'narrow {number}')
+    assert cache.lookup('10.0.50.1') == 'wide'
+    assert cache.lookup('10.0.3.7') == 'narrow 3'
+    assert cache.lookup('11.0.0.1') is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_expired_range_falls_back_to_the_enclosing_one():
+    cache = RDAPCache(path='')
+    cache.store('2001:db8::', '2001:db8:ffff:ffff:ffff:ffff:ffff:ffff', 'wide')
+    cache.store('2001:db8::5', '2001:db8::5', 'Unknown', ttl=0.05)
+    assert cache.lookup('2001:db8::5') == 'Unknown'
+    time.sleep(0.1)
+    assert cache.lookup('2001:db8::5') == 'wide'
+
+
+def test_uncounted_lookup():
+    cache = RDAPCache(path='')
+    cache.store('192.0.2.0', '192.0.2.255', 'Example')
+    assert cache.lookup('192.0.2.1', count=False) == 'Example'
+    assert (cache.hits, cache.misses) == (0, 0)
@@ -0,0 +1,73 @@
+import os, json
+from report_store import ReportStore, ContentIndex, report_key
+
+
+def make_report(report_id):
+    return {'organization': 'receiver.example', 'domain': 'example.com', 'report_id': report_id,
+            'date_range': {'begin': '2026-10-01', 'end': '2026-10-01'}, 'records': []}
+
+
+def test_refresh_after_the_archive_shrank(tmp_path):
+    path = tmp_path / 'reports.json'
+    store = ReportStore(str(path), index_path=str(tmp_path / 'index.json'), rollups_path=None)
+    store.append([make_report('a'), make_report('b')])
+    # Replaced by a shorter archive, e.g. restored from a backup
+    path.write_text(json.dumps(make_report('c')) + '\n')
+
+    store.refresh()
+    assert [report['report_id'] for report in store.reports] == ['c']
+    assert report_key(make_report('a')) not in store.index
+    assert report_key(make_report('c')) in store.index
+
+
+def make_full_report(report_id, day, result):
+    report = make_report(report_id)
+    report['date_range'] = {'begin': day, 'end': day}
+    report['records'] = [{'count': 2, 'auth_results_spf_result': result, 'auth_results_dkim_result': result,
+                          'policy_evaluated_spf': result, 'policy_evaluated_dkim': result}]
+    return report
+
+
+def test_two_processes_share_the_content_index(tmp_path):
+    path = str(tmp_path / 'content_index.log')
+    web, cli = ContentIndex(path), ContentIndex(path)
+    web.add(['a' * 64])
+    web.skip('attachments', 100)
+    web.save()
+    cli.add(['b' * 64])
+    cli.save()
+
+    web.refresh()
+    cli.refresh()
+    assert 'b' * 64 in web and 'a' * 64 in cli
+    # Each copy is counted once, whichever instance dropped it
+    assert web.skipped['attachments'] == cli.skipped['attachments'] == 1
+    assert ContentIndex(path).skipped == {'attachments': 1, 'reports': 0, 'bytes': 100}
+
+
+def test_content_index_converted_from_json(tmp_path):
+    (tmp_path / 'content_index.json').write_text(json.dumps(
+        {'skipped': {'attachments': 3, 'reports': 2, 'bytes': 500}, 'digests': ['c' * 64]}))
+    index = ContentIndex(str(tmp_path / 'content_index.log'))
+    assert 'c' * 64 in index
+    assert index.skipped == {'attachments': 3, 'reports': 2, 'bytes': 500}
+
+
+def test_appends_only_add_to_the_state_files(tmp_path):
+    paths = {'path': str(tmp_path / 'reports.json'), 'index_path': str(tmp_path / 'index.log'),
+             'rollups_path': str(tmp_path / 'rollups.log')}
+    store = ReportStore(**paths)
+    store.append([make_full_report('a', '2026-10-01', 'pass')])
+    sizes = [os.path.getsize(paths[name]) for name in ('index_path', 'rollups_path')]
+    with open(paths['index_path'], 'rb') as f:
+        head = f.read()
+    store.append([make_full_report('b', '2026-10-01', 'fail')])
+    with open(paths['index_path'], 'rb') as f:
+        assert f.read().startswith(head)
+    assert all(os.path.getsize(paths[name]) > size for name, size in zip(('index_path', 'rollups_path'), sizes))
+
+    reopened = ReportStore(**paths)
+    reopened.load()
+    assert len(reopened.index) == 2
+    bucket = reopened.rollups.days['2026-10-01']['example.com']
+    assert (bucket['reports'], bucket['messages'], bucket['results']['auth_results_spf_result']) == (2, 4, {'pass': 1, 'fail': 1})
@@ -0,0 +1,41 @@
+from sqlite_store import SQLiteReportStore
+
+
+def make_report(report_id, records):
+    return {'organization': 'receiver.example', 'domain': 'example.com', 'report_id': report_id,
+            'date_range': {'begin': '2026-10-01', 'end': '2026-10-01'}, 'records': records}
+
+
+def make_record(spf='pass', dkim='fail'):
+    return {'source_ip': '192.0.2.1', 'owner': 'Example', 'count': 3, 'policy_evaluated_disposition': 'none',
+            'policy_evaluated_dkim': dkim, 'policy_evaluated_spf': spf, 'header_from': 'example.com',
+            'envelope_from': 'example.com', 'auth_results_dkim_domain': 'example.com', 'auth_results_dkim_result': dkim,
+            'auth_results_spf_domain': 'example.com', 'auth_results_spf_result': spf}
+
+
+def test_rollups_rebuilt_for_an_empty_report(tmp_path):
+    path = str(tmp_path / 'reports.db')
+    store = SQLiteReportStore(path)
+    assert store.append([make_report('empty', []), make_report('full', [make_record()])]) == 2
+    # A database from before the rollups existed
+    with store.connect() as connection:
+        connection.execute('DELETE FROM daily_rollups')
+
+    reopened = SQLiteReportStore(path)
+    row = reopened.connect().execute('SELECT * FROM daily_rollups').fetchone()
+    assert (row['reports'], row['records'], row['messages']) == (2, 1, 3)
+    assert (row['auth_results_spf_result_pass'], row['auth_results_spf_result_fail']) == (1, 0)
+    assert (row['auth_results_dkim_result_pass'], row['auth_results_dkim_result_fail']) == (0, 1)
+
+
+def test_open_store_with_only_an_empty_report(tmp_path):
+    path = str(tmp_path / 'reports.db')
+    store = SQLiteReportStore(path)
+    store.append([make_report('empty', [])])
+    with store.connect() as connection:
+        connection.execute('DELETE FROM daily_rollups')
+
+    reopened = SQLiteReportStore(path)
+    assert len(reopened) == 1
+    row = reopened.connect().execute('SELECT * FROM daily_rollups').fetchone()
+    assert (row['reports'], row['records'], row['auth_results_spf_result_pass'], row['auth_results_spf_result_fail']) == (1, 0, 0, 0)
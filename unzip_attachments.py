@@ -1,27 +1,28 @@
-import os
-import zipfile
-import gzip
-import shutil
+import os, logging
+from decompression import extract_file, quarantine, RejectedAttachment
+from metrics import configure_logging
+
+logger = logging.getLogger(__name__)
 
 def unzip_files(source_directory, target_directory):
+    if not os.path.isdir(source_directory):
+        return
     if not os.path.exists(target_directory):
         os.makedirs(target_directory)
     
     for filename in os.listdir(source_directory):
         file_path = os.path.join(source_directory, filename)
         
-        if filename.endswith('.zip'):
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(target_directory)
-            os.remove(file_path)
-            print(f'Unzipped and deleted: {filename}')
-        
-        elif filename.endswith('.gz'):
-            with gzip.open(file_path, 'rb') as f_in:
-                with open(os.path.join(target_directory, filename[:-3]), 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+        if filename.endswith('.zip') or filename.endswith('.gz'):
+            # Streamed within the limits of decompression.py, rejected files go to the quarantine folder
+            try:
+                extract_file(file_path, target_directory)
+            except RejectedAttachment as e:
+                quarantine(filename, e, file_path=file_path)
+                continue
             os.remove(file_path)
-            print(f'Extracted and deleted: {filename}')
+            logger.debug('Extracted and deleted: %s', filename)
 
 if __name__ == "__main__":
+    configure_logging()
     unzip_files('./downloaded_mails', './extracted_files')
\ No newline at end of file
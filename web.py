@@ -0,0 +1,141 @@
+"""Flask app and routes shared by the IMAP and Microsoft 365 analyzers.
+
+The analyzers add their home page, /download_attachments and, for
+Microsoft 365, the sign-in routes.
+"""
+import logging
+from datetime import datetime, timedelta
+from flask import Flask, render_template, stream_template, request, jsonify, send_file
+from ingest import load_reports
+from decompression import rejection_counts
+from jobs import job_queue
+from profiling import profile_app, profiled_task, profile_requested, profile_path, profile_text, recent_profiles, PROFILING, FORMATS as PROFILE_FORMATS
+from metrics import configure_logging, instrument_app, render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from report_store import store, RESULT_COLUMNS, aggregate_summary, recent_rollups
+from charts import chart_urls, chart_data, CHART_MODE
+from report_tables import failure_tables, table_view
+
+logger = logging.getLogger(__name__)
+
+
+def create_app(import_name, index_endpoint):
+    app = Flask(import_name)
+    configure_logging()
+    instrument_app(app)
+    profile_app(app, [index_endpoint, 'get_reports'])
+    register_routes(app)
+    return app
+
+
+def home_page():
+    load_reports()
+    domains = store.domains()
+
+    now = datetime.now()
+    week_ago = now - timedelta(days=7)
+
+    failed_domains = store.failed_domains(week_ago.strftime('%Y-%m-%d'), now.strftime('%Y-%m-%d'))
+
+    return render_template('home.html', domains=domains, failed_domains=failed_domains, jobs=job_queue.recent(5))
+
+
+def submit_ingest(task):
+    # Runs in the background, the progress is shown on the main page and at /api/jobs/<id>
+    if profile_requested(request):
+        # The import runs in the job thread, that is what gets profiled
+        task = profiled_task(task, 'ingest')
+    return job_queue.submit('ingest', task)
+
+
+def report_filters():
+    domain = request.args.get('domain')
+    start_date_str = request.args.get('start_date')
+    end_date_str = request.args.get('end_date')
+
+    logger.debug('Report filters: %s, %s to %s', domain, start_date_str, end_date_str)
+
+    date_format = '%Y-%m-%d'
+
+    try:
+        # Normalised to 'YYYY-MM-DD' so the store can compare them directly
+        start_date = datetime.strptime(start_date_str, date_format).strftime(date_format)
+        end_date = datetime.strptime(end_date_str, date_format).strftime(date_format)
+    except (TypeError, ValueError):
+        start_date = None
+        end_date = None
+    return domain, start_date, end_date
+
+
+def register_routes(app):
+    @app.route('/reports', methods=['GET'])
+    def get_reports():
+        domain, start_date, end_date = report_filters()
+        load_reports()
+        if not store.count_reports(domain, start_date, end_date):
+            return render_template('report_empty.html', domain=domain)
+
+        if CHART_MODE == 'server':
+            # Charts are only rendered when their counts have not been drawn before
+            graphs = chart_urls(lambda: store.result_counts(RESULT_COLUMNS, domain, start_date, end_date, weighted=True),
+                                key=(domain, start_date, end_date, store.version))
+            charts = []
+        else:
+            graphs = []
+            charts = chart_data(store.result_counts(RESULT_COLUMNS, domain, start_date, end_date, weighted=True))
+
+        # Totals come from the summary, the tables themselves are paged and only queried while streaming
+        summary = store.failure_summary(RESULT_COLUMNS, domain, start_date, end_date)
+        tables = failure_tables(store, summary, domain, start_date, end_date)
+        has_failures = any(summary[column]['records'] for column in RESULT_COLUMNS)
+
+        return stream_template('report.html', domain=domain, graphs=graphs, charts=charts, statistics=[], tables=tables, has_failures=has_failures, table_view=table_view())
+
+    @app.route('/api/reports/aggregates', methods=['GET'])
+    def report_aggregates():
+        domain, start_date, end_date = report_filters()
+        load_reports()
+        return jsonify(aggregate_summary(store, domain, start_date, end_date))
+
+    @app.route('/api/rollups', methods=['GET'])
+    def daily_rollups():
+        days = request.args.get('days', 7, type=int)
+        domain = request.args.get('domain')
+        load_reports()
+        return jsonify(recent_rollups(store, days, domain))
+
+    @app.route('/api/jobs', methods=['GET'])
+    def list_jobs():
+        return jsonify([job.to_dict() for job in job_queue.recent()])
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return jsonify(job.to_dict())
+
+    @app.route('/api/rejections', methods=['GET'])
+    def list_rejections():
+        # Attachments quarantined by this process, per reason
+        return jsonify(rejection_counts())
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        # Prometheus text format, counters and latency histograms of every stage since the analyzer started
+        return render_metrics(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
+    @app.route('/api/profiles', methods=['GET'])
+    def list_profiles():
+        # Newest first, only with PROFILING=true
+        if not PROFILING:
+            return jsonify({'error': 'Profiling is disabled'}), 404
+        return jsonify(recent_profiles())
+
+    @app.route('/api/profiles/<name>.<extension>', methods=['GET'])
+    def download_profile(name, extension):
+        path = profile_path(name) if PROFILING and extension in PROFILE_FORMATS else None
+        if path is None:
+            return jsonify({'error': 'Unknown profile'}), 404
+        if extension == 'txt':
+            return profile_text(name), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+        return send_file(profile_path(name, extension), as_attachment=True)